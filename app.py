@@ -1,19 +1,41 @@
 import openai
+import asyncio
+from openai import AssistantEventHandler
 import logging
 import os
+import sys
 
 port = os.environ.get('PORT', '8080')
 os.environ['STREAMLIT_SERVER_PORT'] = port
 os.environ['STREAMLIT_SERVER_ADDRESS'] = '0.0.0.0'
 
 import streamlit as st
+from streamlit import runtime
 import pymysql
 import argon2
 import json
-import requests
+import httpx
 import time
-from PIL import Image
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from pymysql.constants import SERVER_STATUS
+from PIL import Image, ImageOps
 import io
+import re
+import uuid
+import hashlib
+import random
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Under "streamlit run", __main__.__file__ is this script, so the spawned password-hash workers re-run it
+# as __mp_main__. They only need argon2.low_level, so they skip the page, client, pool and thread setup.
+IN_WORKER_PROCESS = __name__ == '__mp_main__'
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -21,11 +43,297 @@ logger = logging.getLogger(__name__)
 
 # Set up OpenAI API key
 openai.api_key = os.getenv('OPENAI_API_KEY')
-client = openai
+client = openai  # Sync client, still used for streaming runs into st.write_stream
+
+if not IN_WORKER_PROCESS:
+    st.set_page_config(page_title="AI Assistant Solutions", layout="wide", initial_sidebar_state="expanded")
+
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+OPENAI_HTTP_POOL_SIZE = int(os.environ.get('OPENAI_HTTP_POOL_SIZE', '20'))
+OPENAI_HTTP_CONNECT_TIMEOUT = float(os.environ.get('OPENAI_HTTP_CONNECT_TIMEOUT', '5'))
+OPENAI_HTTP_READ_TIMEOUT = float(os.environ.get('OPENAI_HTTP_READ_TIMEOUT', '60'))
+OPENAI_HTTP_MAX_RETRIES = int(os.environ.get('OPENAI_HTTP_MAX_RETRIES', '3'))
+
+@st.cache_resource
+def get_http_client():
+    # One keep-alive connection pool per process, shared by the SDK and the raw file endpoints
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=OPENAI_HTTP_POOL_SIZE, max_keepalive_connections=OPENAI_HTTP_POOL_SIZE),
+        timeout=httpx.Timeout(OPENAI_HTTP_READ_TIMEOUT, connect=OPENAI_HTTP_CONNECT_TIMEOUT),
+    )
 
-st.set_page_config(page_title="AI Assistant Solutions", layout="wide", initial_sidebar_state="expanded")
+if not IN_WORKER_PROCESS:
+    http_client = get_http_client()
+    openai.base_url = OPENAI_BASE_URL
+    openai.http_client = http_client
+    openai.max_retries = 0  # Retries go through the scheduler in AsyncOpenAIService
+
+def openai_api_get(path):
+    # GET against the OpenAI REST API, retrying 429/5xx responses and connection errors with the same
+    # jittered backoff as AsyncOpenAIService.call
+    url = f"{OPENAI_BASE_URL.rstrip('/')}/{path}"
+    headers = {"Authorization": f"Bearer {openai.api_key}"}
+    for attempt in range(OPENAI_HTTP_MAX_RETRIES + 1):
+        try:
+            with openai_service.slot():
+                response = http_client.get(url, headers=headers)
+        except httpx.TransportError as e:
+            if attempt == OPENAI_HTTP_MAX_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+            openai_service.retrying(delay, False)
+            logging.warning(f"GET {path} failed ({str(e)}), retrying in {delay:.1f}s")
+        else:
+            if (response.status_code != 429 and response.status_code < 500) or attempt == OPENAI_HTTP_MAX_RETRIES:
+                return response
+            delay = retry_delay(attempt, response)
+            openai_service.retrying(delay, response.status_code == 429)
+            logging.warning(f"GET {path} returned {response.status_code}, retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+OPENAI_MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', '16'))
+OPENAI_CALL_TIMEOUT = float(os.environ.get('OPENAI_CALL_TIMEOUT', '120'))
+OPENAI_RPM_LIMIT = int(os.environ.get('OPENAI_RPM_LIMIT', '500'))  # 0 disables the limit
+OPENAI_TPM_LIMIT = int(os.environ.get('OPENAI_TPM_LIMIT', '200000'))  # 0 disables the limit
+OPENAI_RETRY_ATTEMPTS = int(os.environ.get('OPENAI_RETRY_ATTEMPTS', '4'))
+OPENAI_RETRY_BACKOFF = float(os.environ.get('OPENAI_RETRY_BACKOFF', '1'))
+# Streamed runs (e.g. long code interpreter answers) outlive OPENAI_CALL_TIMEOUT; only their start is a call
+OPENAI_STREAM_TIMEOUT = float(os.environ.get('OPENAI_STREAM_TIMEOUT', '900'))
+# Open streams hold no request slot, so they are capped separately
+OPENAI_MAX_STREAMS = int(os.environ.get('OPENAI_MAX_STREAMS', '64'))
+OPENAI_RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+# Who the current OpenAI request is for; set per submitted coroutine so fair queuing can tell users apart
+openai_user = contextvars.ContextVar('openai_user', default='background')
+
+def current_openai_user():
+    # Script threads have a session. Executor threads get their user from submit_as_user; other worker
+    # threads (file GC, metrics) share the 'background' queue.
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None:
+        return openai_user.get()
+    return f"user:{st.session_state.get('user_id') or ctx.session_id}"
+
+def submit_as_user(executor, fn, *args):
+    # executor.submit that carries the calling session's OpenAI user to the worker thread
+    context = contextvars.copy_context()
+    context.run(openai_user.set, current_openai_user())
+    return executor.submit(context.run, fn, *args)
+
+def retry_delay(attempt, response=None):
+    # Full jitter on exponential backoff, but never sooner than the server's Retry-After
+    delay = random.uniform(0, OPENAI_RETRY_BACKOFF * 2 ** attempt)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get('retry-after', 0)) + random.uniform(0, OPENAI_RETRY_BACKOFF))
+        except ValueError:
+            pass
+    return delay
+
+class TokenBucket:
+    # Refills continuously at per_minute / 60 per second; the level may go negative when charged after the fact
+    def __init__(self, per_minute):
+        self._per_minute = per_minute
+        self._level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self._per_minute, self._level + (now - self._updated) * self._per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount):
+        if not self._per_minute:
+            return 0.0
+        self._refill()
+        return 0.0 if self._level >= amount else (amount - self._level) * 60 / self._per_minute
+
+    def take(self, amount):
+        if self._per_minute:
+            self._refill()
+            self._level -= amount
+
+class OpenAIScheduler:
+    # Grants request slots under the concurrency, requests-per-minute and tokens-per-minute limits,
+    # round-robin across users so a user with many queued requests can't starve the others.
+    # Only touched from the service event loop, so it needs no locks.
+    def __init__(self, max_concurrency, rpm, tpm):
+        self._max_concurrency = max_concurrency
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._queues = OrderedDict()  # user -> deque of waiting futures, in round-robin order
+        self._active = 0
+        self._paused_until = 0.0
+        self._timer = None
+        self._metrics = {'granted': 0, 'queue_wait_total': 0.0, 'queue_wait_max': 0.0, 'throttled': 0,
+                         'rate_limited': 0, 'retries': 0, 'tokens_charged': 0}
+
+    async def acquire(self, user):
+        waiter = asyncio.get_running_loop().create_future()
+        enqueued = time.monotonic()
+        self._queues.setdefault(user, deque()).append(waiter)
+        self._dispatch()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # Granted just as the caller gave up
+            raise
+        waited = time.monotonic() - enqueued
+        self._metrics['queue_wait_total'] += waited
+        self._metrics['queue_wait_max'] = max(self._metrics['queue_wait_max'], waited)
+
+    def release(self):
+        self._active -= 1
+        self._dispatch()
+
+    def charge_tokens(self, tokens):
+        # Token use is only known once a run finishes, so it is charged afterwards and delays later requests
+        self._tokens.take(tokens)
+        self._metrics['tokens_charged'] += tokens
+
+    def retrying(self, delay, rate_limited):
+        self._metrics['retries'] += 1
+        if rate_limited:
+            # A 429 means the shared key is over its limit; hold every user's requests, not just the caller's
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._metrics['rate_limited'] += 1
+
+    def _dispatch(self):
+        while self._queues and self._active < self._max_concurrency:
+            wait = max(self._paused_until - time.monotonic(), self._requests.wait_time(1), self._tokens.wait_time(0))
+            if wait > 0:
+                self._metrics['throttled'] += 1
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._wake)
+                return
+            user, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            if waiter.done():
+                continue  # Cancelled while queued
+            self._requests.take(1)
+            self._active += 1
+            self._metrics['granted'] += 1
+            waiter.set_result(None)
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+    def stats(self):
+        stats = dict(self._metrics)
+        stats['active'] = self._active
+        stats['queued'] = sum(len(waiters) for waiters in self._queues.values())
+        stats['queued_users'] = len(self._queues)
+        stats['queue_wait_avg'] = stats['queue_wait_total'] / stats['granted'] if stats['granted'] else 0.0
+        return stats
+
+class AsyncOpenAIService:
+    # Owns an AsyncOpenAI client, the event loop thread it runs on and the request scheduler, shared by
+    # every session
+    def __init__(self, max_concurrency, max_streams, timeout):
+        self._timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='openai-async', daemon=True)
+        self._thread.start()
+        # Loop-bound primitives have to be created on the loop itself
+        self.client, self.scheduler, self.streams = self.run(self._setup(max_concurrency, max_streams))
+
+    async def _setup(self, max_concurrency, max_streams):
+        async_client = openai.AsyncOpenAI(
+            api_key=openai.api_key,
+            base_url=OPENAI_BASE_URL,
+            timeout=httpx.Timeout(OPENAI_HTTP_READ_TIMEOUT, connect=OPENAI_HTTP_CONNECT_TIMEOUT),
+            max_retries=0,  # Retried by call() so every attempt is rate limited and queued fairly
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=OPENAI_HTTP_POOL_SIZE,
+                                    max_keepalive_connections=OPENAI_HTTP_POOL_SIZE),
+            ),
+        )
+        return (async_client, OpenAIScheduler(max_concurrency, OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT),
+                asyncio.Semaphore(max_streams))
 
-def get_db_connection():
+    async def call(self, fn, *args, **kwargs):
+        # Every OpenAI request goes through the scheduler, the timeout and retry with backoff
+        for attempt in range(OPENAI_RETRY_ATTEMPTS + 1):
+            await self.scheduler.acquire(openai_user.get())
+            try:
+                return await asyncio.wait_for(fn(*args, **kwargs), self._timeout)
+            except OPENAI_RETRYABLE_ERRORS as e:
+                if attempt == OPENAI_RETRY_ATTEMPTS:
+                    raise
+                delay = retry_delay(attempt, getattr(e, 'response', None))
+                self.scheduler.retrying(delay, isinstance(e, openai.RateLimitError))
+                logging.warning(f"OpenAI call {getattr(fn, '__qualname__', fn)} failed ({str(e)}), "
+                                f"retrying in {delay:.1f}s")
+            finally:
+                self.scheduler.release()
+            await asyncio.sleep(delay)
+
+    def run(self, coro):
+        # Blocks the calling (script) thread until the coroutine finishes on the service loop
+        return self.submit(coro).result()
+
+    def submit(self, coro, user=None):
+        # Starts the coroutine on the service loop and returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(self._run_as(user or current_openai_user(), coro), self._loop)
+
+    async def _run_as(self, user, coro):
+        # Tasks started by coro (e.g. asyncio.gather) inherit this context
+        openai_user.set(user)
+        return await coro
+
+    @contextmanager
+    def slot(self):
+        # Holds a scheduler slot on the calling thread, for the sync streaming client
+        self.run(self.scheduler.acquire(current_openai_user()))
+        try:
+            yield
+        finally:
+            self._loop.call_soon_threadsafe(self.scheduler.release)
+
+    @contextmanager
+    def stream_slot(self):
+        # Holds one of the open-stream slots on the calling thread while a sync stream is read
+        self.run(self.streams.acquire())
+        try:
+            yield
+        finally:
+            self._loop.call_soon_threadsafe(self.streams.release)
+
+    def charge_tokens(self, tokens):
+        self._loop.call_soon_threadsafe(self.scheduler.charge_tokens, tokens)
+
+    def retrying(self, delay, rate_limited):
+        self._loop.call_soon_threadsafe(self.scheduler.retrying, delay, rate_limited)
+
+    def stats(self):
+        async def read_stats():
+            return self.scheduler.stats()
+        return self.run(read_stats())
+
+@st.cache_resource
+def get_openai_service():
+    return AsyncOpenAIService(OPENAI_MAX_CONCURRENCY, OPENAI_MAX_STREAMS, OPENAI_CALL_TIMEOUT)
+
+if not IN_WORKER_PROCESS:
+    openai_service = get_openai_service()
+    aclient = openai_service.client
+
+def run_openai(fn, *args, **kwargs):
+    # Sync wrapper for a single async client call, e.g. run_openai(aclient.files.delete, file_id)
+    return openai_service.run(openai_service.call(fn, *args, **kwargs))
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_IDLE_SECONDS = float(os.environ.get('DB_POOL_IDLE_SECONDS', '300'))
+DB_POOL_PING_SECONDS = float(os.environ.get('DB_POOL_PING_SECONDS', '5'))
+
+def create_db_connection():
     # Fetch database connection details from environment variables
     db_user = os.environ.get('DB_USER', 'root')
     db_pass = os.environ.get('DB_PASS', '')  # Empty string for no password
@@ -57,49 +365,401 @@ def get_db_connection():
         )
     return connection
 
-def init_db():
-    conn = get_db_connection()
-    with conn.cursor() as c:
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-                        id INT AUTO_INCREMENT PRIMARY KEY,
-                        username VARCHAR(255) UNIQUE,
-                        password TEXT,
-                        thread_id TEXT
-                    )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS user_assistants (
-                        id INT AUTO_INCREMENT PRIMARY KEY,
-                        user_id INT,
-                        assistant_id TEXT,
-                        name TEXT,
-                        description TEXT,
-                        instructions TEXT,
-                        file_ids TEXT,
-                        FOREIGN KEY (user_id) REFERENCES users(id)
-                    )''')
-        # Check if 'file_ids' column exists
-        c.execute("SHOW COLUMNS FROM user_assistants LIKE 'file_ids'")
-        result = c.fetchone()
-        if not result:
-            c.execute("ALTER TABLE user_assistants ADD COLUMN file_ids TEXT")
-    conn.commit()
-    conn.close()
+class PooledConnection:
+    # Wraps a pymysql connection so that close() hands it back to the pool
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self, discard=False):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn, discard=discard)
+
+class ConnectionPool:
+    def __init__(self, creator, max_size, timeout, idle_seconds, ping_seconds):
+        self._creator = creator
+        self._max_size = max_size
+        self._timeout = timeout
+        self._idle_seconds = idle_seconds
+        self._ping_seconds = ping_seconds
+        self._idle = []  # (connection, returned_at), most recently returned last
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._metrics = {
+            'checkouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'evicted': 0,
+        }
+
+    def _evict_idle(self, now):
+        expired = [item for item in self._idle if now - item[1] > self._idle_seconds]
+        if expired:
+            self._idle = [item for item in self._idle if now - item[1] <= self._idle_seconds]
+            self._metrics['evicted'] += len(expired)
+        return [conn for conn, _ in expired]
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self._timeout
+        conn, returned_at, expired = None, None, []
+        with self._cond:
+            while True:
+                expired += self._evict_idle(time.monotonic())
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._in_use < self._max_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._metrics['timeouts'] += 1
+                    raise TimeoutError(f"Timed out waiting {self._timeout}s for a database connection")
+                self._cond.wait(remaining)
+            self._in_use += 1
+        for stale in expired:
+            self._close_quietly(stale)
+
+        try:
+            # Health check connections that sat idle long enough to have been dropped by the server
+            if conn is not None and time.monotonic() - returned_at >= self._ping_seconds:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._close_quietly(conn)
+                    conn = None
+                    with self._cond:
+                        self._metrics['discarded'] += 1
+            if conn is None:
+                conn = self._creator()
+                with self._cond:
+                    self._metrics['created'] += 1
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._metrics['checkouts'] += 1
+            self._metrics['wait_seconds_total'] += waited
+            self._metrics['wait_seconds_max'] = max(self._metrics['wait_seconds_max'], waited)
+        return PooledConnection(self, conn)
+
+    def release(self, conn, discard=False):
+        if not discard:
+            try:
+                # Never hand out a connection with a transaction left open by the previous user
+                if conn.open and conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    conn.rollback()
+                discard = not conn.open
+            except Exception:
+                discard = True
+        if discard:
+            self._close_quietly(conn)
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._metrics['discarded'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._metrics)
+            stats['in_use'] = self._in_use
+            stats['idle'] = len(self._idle)
+            stats['max_size'] = self._max_size
+        checkouts = stats['checkouts']
+        stats['wait_seconds_avg'] = stats['wait_seconds_total'] / checkouts if checkouts else 0.0
+        return stats
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+@st.cache_resource
+def get_db_pool():
+    # Shared by every Streamlit session in this process
+    return ConnectionPool(create_db_connection, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_IDLE_SECONDS,
+                          DB_POOL_PING_SECONDS)
+
+if not IN_WORKER_PROCESS:
+    db_pool = get_db_pool()
+
+def get_db_connection():
+    # Returned connections go back to the pool on close() or at the end of a with block
+    return db_pool.acquire()
+
+SCHEMA_LOCK_NAME = 'assistant_db_schema'
+SCHEMA_LOCK_TIMEOUT = int(os.environ.get('SCHEMA_LOCK_TIMEOUT', '60'))
+
+def migrate_initial_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    username VARCHAR(255) UNIQUE,
+                    password TEXT,
+                    thread_id TEXT
+                )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS user_assistants (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    user_id INT,
+                    assistant_id TEXT,
+                    name TEXT,
+                    description TEXT,
+                    instructions TEXT,
+                    file_ids TEXT,
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )''')
+    # Databases created before file_ids existed
+    c.execute("SHOW COLUMNS FROM user_assistants LIKE 'file_ids'")
+    if not c.fetchone():
+        c.execute("ALTER TABLE user_assistants ADD COLUMN file_ids TEXT")
+
+def column_exists(c, table, column):
+    c.execute(f"SHOW COLUMNS FROM {table} LIKE %s", (column,))
+    return c.fetchone() is not None
+
+def index_exists(c, table, index):
+    c.execute(f"SHOW INDEX FROM {table} WHERE Key_name = %s", (index,))
+    return c.fetchone() is not None
+
+def migrate_assistant_files(c):
+    c.execute("ALTER TABLE user_assistants MODIFY assistant_id VARCHAR(64)")
+    if not index_exists(c, 'user_assistants', 'idx_user_assistants_user_id'):
+        c.execute("CREATE INDEX idx_user_assistants_user_id ON user_assistants (user_id)")
+    if not index_exists(c, 'user_assistants', 'idx_user_assistants_assistant_id'):
+        c.execute("CREATE INDEX idx_user_assistants_assistant_id ON user_assistants (assistant_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS assistant_files (
+                    assistant_id VARCHAR(64) NOT NULL,
+                    file_id VARCHAR(64) NOT NULL,
+                    purpose VARCHAR(32),
+                    shared BOOLEAN NOT NULL DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (assistant_id, file_id),
+                    INDEX idx_assistant_files_file_id (file_id)
+                )''')
+    # One-shot copy of the old JSON file_ids blobs; purpose is unknown for these rows
+    if column_exists(c, 'user_assistants', 'file_ids'):
+        c.execute("SELECT assistant_id, file_ids FROM user_assistants WHERE file_ids IS NOT NULL")
+        rows = [(row['assistant_id'], file_id)
+                for row in c.fetchall()
+                for file_id in json.loads(row['file_ids'] or '[]')]
+        if rows:
+            c.executemany("INSERT IGNORE INTO assistant_files (assistant_id, file_id) VALUES (%s, %s)", rows)
+        c.execute("ALTER TABLE user_assistants DROP COLUMN file_ids")
+
+def migrate_tool_state_columns(c):
+    # JSON copies of the tools and tool_resources last sent to OpenAI
+    if not column_exists(c, 'user_assistants', 'tools'):
+        c.execute("ALTER TABLE user_assistants ADD COLUMN tools TEXT")
+    if not column_exists(c, 'user_assistants', 'tool_resources'):
+        c.execute("ALTER TABLE user_assistants ADD COLUMN tool_resources TEXT")
+
+def migrate_file_deletion_queue(c):
+    # status: held (until the user's next new thread), pending, in_progress, done or failed
+    c.execute('''CREATE TABLE IF NOT EXISTS file_deletion_queue (
+                    file_id VARCHAR(64) PRIMARY KEY,
+                    user_id INT,
+                    status VARCHAR(16) NOT NULL DEFAULT 'held',
+                    attempts INT NOT NULL DEFAULT 0,
+                    next_attempt_at TIMESTAMP NULL,
+                    claimed_by VARCHAR(64),
+                    claimed_at TIMESTAMP NULL,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    deleted_at TIMESTAMP NULL,
+                    INDEX idx_file_deletion_queue_status (status, next_attempt_at),
+                    INDEX idx_file_deletion_queue_user (user_id, status)
+                )''')
+
+def migrate_chat_messages(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS chat_messages (
+                    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    thread_id VARCHAR(64) NOT NULL,
+                    role VARCHAR(16) NOT NULL,
+                    assistant_name VARCHAR(255),
+                    content MEDIUMTEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    INDEX idx_chat_messages_thread_id (thread_id, id)
+                )''')
+
+def migrate_run_settings_columns(c):
+    # NULL means no limit for that setting
+    for column in RUN_SETTINGS:
+        if not column_exists(c, 'user_assistants', column):
+            c.execute(f"ALTER TABLE user_assistants ADD COLUMN {column} INT NULL")
+
+def migrate_run_metrics(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS run_metrics (
+                    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    user_id INT NOT NULL,
+                    assistant_id VARCHAR(255) NOT NULL,
+                    thread_id VARCHAR(64) NOT NULL,
+                    run_id VARCHAR(64),
+                    status VARCHAR(32),
+                    prompt_tokens INT,
+                    completion_tokens INT,
+                    total_tokens INT,
+                    queue_seconds DOUBLE,
+                    first_token_seconds DOUBLE,
+                    total_seconds DOUBLE,
+                    image_seconds DOUBLE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    INDEX idx_run_metrics_user_created (user_id, created_at),
+                    INDEX idx_run_metrics_assistant_created (assistant_id, created_at),
+                    INDEX idx_run_metrics_thread_id (thread_id)
+                )''')
+
+def migrate_file_blobs(c):
+    # Content hashes of uploads, so re-uploading the same bytes reuses the existing OpenAI file
+    c.execute('''CREATE TABLE IF NOT EXISTS file_blobs (
+                    user_id INT NOT NULL,
+                    sha256 CHAR(64) NOT NULL,
+                    purpose VARCHAR(32) NOT NULL,
+                    file_id VARCHAR(64) NOT NULL,
+                    filename VARCHAR(255),
+                    size BIGINT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, sha256, purpose),
+                    INDEX idx_file_blobs_file_id (file_id)
+                )''')
+
+def migrate_user_state(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS user_state (
+                    user_id INT NOT NULL,
+                    state_key VARCHAR(64) NOT NULL,
+                    value TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, state_key)
+                )''')
+
+def migrate_file_deletion_claim_index(c):
+    # The GC worker reads its claimed batch back by claim token
+    if not index_exists(c, 'file_deletion_queue', 'idx_file_deletion_queue_claimed_by'):
+        c.execute("CREATE INDEX idx_file_deletion_queue_claimed_by ON file_deletion_queue (claimed_by)")
+
+def migrate_chat_messages_user_id(c):
+    if not column_exists(c, 'chat_messages', 'user_id'):
+        c.execute("ALTER TABLE chat_messages ADD COLUMN user_id INT NULL AFTER id")
+    if not index_exists(c, 'chat_messages', 'idx_chat_messages_user_id'):
+        c.execute("CREATE INDEX idx_chat_messages_user_id ON chat_messages (user_id)")
+    # Attribute existing rows through each user's current thread and the threads their runs were recorded on
+    c.execute("""
+        UPDATE chat_messages cm JOIN users u ON u.thread_id = cm.thread_id
+        SET cm.user_id = u.id WHERE cm.user_id IS NULL
+    """)
+    c.execute("""
+        UPDATE chat_messages cm
+        JOIN (SELECT DISTINCT thread_id, user_id FROM run_metrics) rm ON rm.thread_id = cm.thread_id
+        SET cm.user_id = rm.user_id WHERE cm.user_id IS NULL
+    """)
+
+def migrate_assistant_state_version(c):
+    # Bumped with every change to an assistant's files, tool state or run settings, so an instance can tell
+    # its cached copy is stale without re-reading the assistant
+    if not column_exists(c, 'user_assistants', 'state_version'):
+        c.execute("ALTER TABLE user_assistants ADD COLUMN state_version INT NOT NULL DEFAULT 0")
+
+# Ordered (version, description, migration) entries; append new ones, never edit applied ones
+MIGRATIONS = [
+    (1, 'initial users and user_assistants tables', migrate_initial_schema),
+    (2, 'assistant_files join table and assistant_id indexes', migrate_assistant_files),
+    (3, 'cached tools and tool_resources on user_assistants', migrate_tool_state_columns),
+    (4, 'file_deletion_queue table', migrate_file_deletion_queue),
+    (5, 'chat_messages transcript table', migrate_chat_messages),
+    (6, 'per-assistant run truncation and token limits', migrate_run_settings_columns),
+    (7, 'run_metrics usage and latency table', migrate_run_metrics),
+    (8, 'file_blobs upload content hashes', migrate_file_blobs),
+    (9, 'user_state per-user session settings', migrate_user_state),
+    (10, 'file_deletion_queue claimed_by index', migrate_file_deletion_claim_index),
+    (11, 'chat_messages user_id', migrate_chat_messages_user_id),
+    (12, 'user_assistants state_version', migrate_assistant_state_version),
+]
+
+def migrate_db():
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            # Serialize migrations across Cloud Run instances
+            c.execute("SELECT GET_LOCK(%s, %s) AS acquired", (SCHEMA_LOCK_NAME, SCHEMA_LOCK_TIMEOUT))
+            if not c.fetchone()['acquired']:
+                raise RuntimeError(f"Could not acquire schema lock within {SCHEMA_LOCK_TIMEOUT}s")
+            try:
+                c.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+                                version INT PRIMARY KEY,
+                                description VARCHAR(255),
+                                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                            )''')
+                c.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version")
+                current_version = c.fetchone()['version']
+                for version, description, migration in MIGRATIONS:
+                    if version <= current_version:
+                        continue
+                    logging.info(f"Applying schema migration {version}: {description}")
+                    migration(c)
+                    c.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                              (version, description))
+                    conn.commit()
+                    current_version = version
+            finally:
+                c.execute("SELECT RELEASE_LOCK(%s)", (SCHEMA_LOCK_NAME,))
+        conn.commit()
+    return current_version
+
+@st.cache_resource
+def ensure_schema():
+    # Runs once per process; Streamlit reruns reuse the cached result
+    version = migrate_db()
+    logging.info(f"Database schema at version {version}")
+    return version
 
 def reset_db():
-    conn = get_db_connection()
-    with conn.cursor() as c:
-        c.execute("DROP TABLE IF EXISTS user_assistants")
-        c.execute("DROP TABLE IF EXISTS users")
-    conn.commit()
-    conn.close()
-    init_db()
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("DROP TABLE IF EXISTS user_state")
+            c.execute("DROP TABLE IF EXISTS file_blobs")
+            c.execute("DROP TABLE IF EXISTS run_metrics")
+            c.execute("DROP TABLE IF EXISTS chat_messages")
+            c.execute("DROP TABLE IF EXISTS file_deletion_queue")
+            c.execute("DROP TABLE IF EXISTS assistant_files")
+            c.execute("DROP TABLE IF EXISTS user_assistants")
+            c.execute("DROP TABLE IF EXISTS users")
+            c.execute("DROP TABLE IF EXISTS schema_version")
+        conn.commit()
+    migrate_db()
+
+async def async_list_files(purpose):
+    return {file.id: file.filename async for file in aclient.files.list(purpose=purpose)}
+
+async def async_get_assistant_files():
+    # Both listings page independently, so fetch them concurrently
+    return await asyncio.gather(
+        openai_service.call(async_list_files, 'assistants'),
+        openai_service.call(async_list_files, 'vision'),
+    )
 
 def get_assistant_files():
     try:
-        assistant_files = client.files.list(purpose='assistants')
-        vision_files = client.files.list(purpose='vision')
-
-        assistant_file_dict = {file.id: file.filename for file in assistant_files}
-        vision_file_dict = {file.id: file.filename for file in vision_files}
+        assistant_file_dict, vision_file_dict = openai_service.run(async_get_assistant_files())
 
         return {
             'assistants': assistant_file_dict,
@@ -109,9 +769,164 @@ def get_assistant_files():
         logging.error(f"Error retrieving files: {str(e)}")
         return {'assistants': {}, 'vision': {}}
 
+STATE_STORE_BACKEND = os.environ.get('STATE_STORE_BACKEND', 'mysql')  # mysql, redis or memory
+STATE_STORE_REDIS_URL = os.environ.get('STATE_STORE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Session keys that follow the user to whichever instance serves the next request. Assistants, file
+# references and the deletion queue already live in MySQL; these are the per-user settings that were
+# only kept in one process's st.session_state.
+PERSISTED_STATE_KEYS = ['selected_assistant', 'share_files', 'display_images', 'broadcast_assistants',
+                        'broadcast_threads']
+
+# State stores map user_id -> {key: JSON-serializable value} with load, save and delete_user
+
+class MemoryStateStore:
+    # Process-local; for tests and single-instance development
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+
+    def load(self, user_id):
+        with self._lock:
+            return json.loads(json.dumps(self._users.get(user_id, {})))
+
+    def save(self, user_id, values):
+        with self._lock:
+            self._users.setdefault(user_id, {}).update(json.loads(json.dumps(values)))
+
+    def delete_user(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+class MySQLStateStore:
+    def load(self, user_id):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT state_key, value FROM user_state WHERE user_id = %s", (user_id,))
+                return {row['state_key']: json.loads(row['value']) for row in c.fetchall()}
+
+    def save(self, user_id, values):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.executemany("""
+                    INSERT INTO user_state (user_id, state_key, value) VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE value = VALUES(value)
+                """, [(user_id, key, json.dumps(value)) for key, value in values.items()])
+            conn.commit()
+
+    def delete_user(self, user_id):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute("DELETE FROM user_state WHERE user_id = %s", (user_id,))
+            conn.commit()
+
+class RedisStateStore:
+    # One hash per user; works with any Redis-compatible server (Memorystore, Valkey, KeyDB)
+    def __init__(self, url):
+        import redis  # Optional dependency, only needed for this backend
+        self._client = redis.Redis.from_url(url)
+
+    def _key(self, user_id):
+        return f"user_state:{user_id}"
+
+    def load(self, user_id):
+        return {key.decode('utf-8'): json.loads(value) for key, value in self._client.hgetall(self._key(user_id)).items()}
+
+    def save(self, user_id, values):
+        self._client.hset(self._key(user_id), mapping={key: json.dumps(value) for key, value in values.items()})
+
+    def delete_user(self, user_id):
+        self._client.delete(self._key(user_id))
+
+@st.cache_resource
+def get_state_store():
+    if STATE_STORE_BACKEND == 'redis':
+        return RedisStateStore(STATE_STORE_REDIS_URL)
+    if STATE_STORE_BACKEND == 'memory':
+        return MemoryStateStore()
+    return MySQLStateStore()
+
+def load_session_state(user_id):
+    # Called at login, before any widget reads these keys
+    try:
+        values = get_state_store().load(user_id)
+    except Exception as e:
+        logging.error(f"Error loading session state for user {user_id}: {str(e)}")
+        values = {}
+    for key in PERSISTED_STATE_KEYS:
+        if key in values:
+            st.session_state[key] = values[key]
+    st.session_state.persisted_state = {key: json.dumps(values[key], sort_keys=True)
+                                        for key in PERSISTED_STATE_KEYS if key in values}
+
+def save_session_state():
+    # Write-through: st.session_state stays the read cache, and only changed keys reach the store
+    if st.session_state.get('user_id') is None:
+        return
+    persisted = st.session_state.setdefault('persisted_state', {})
+    changed = {}
+    for key in PERSISTED_STATE_KEYS:
+        if key in st.session_state:
+            encoded = json.dumps(st.session_state[key], sort_keys=True)
+            if persisted.get(key) != encoded:
+                changed[key] = (st.session_state[key], encoded)
+    if not changed:
+        return
+    try:
+        get_state_store().save(st.session_state.user_id, {key: value for key, (value, _) in changed.items()})
+        persisted.update({key: encoded for key, (_, encoded) in changed.items()})
+    except Exception as e:
+        logging.error(f"Error saving session state for user {st.session_state.user_id}: {str(e)}")
+
+def clear_user_session():
+    # Logout and account deletion; render_app restores the logged-out defaults on the next run, so no
+    # persisted setting of this user carries over to whoever logs in next in this browser session
+    for key in ['user_id', 'thread_id', 'username', 'assistants', 'messages', 'transcript_oldest_id',
+                'transcript_has_more', 'transcript_window', 'persisted_state'] + PERSISTED_STATE_KEYS:
+        if key in st.session_state:
+            del st.session_state[key]
+
+class ScriptTimings:
+    # Per-interaction script execution time, split by full reruns and chat fragment reruns
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = {}
+
+    def record(self, kind, seconds):
+        with self._lock:
+            timing = self._timings.setdefault(kind, {'runs': 0, 'seconds_total': 0.0, 'seconds_max': 0.0})
+            timing['runs'] += 1
+            timing['seconds_total'] += seconds
+            timing['seconds_max'] = max(timing['seconds_max'], seconds)
+            average = timing['seconds_total'] / timing['runs']
+        logging.info(f"{kind} script run took {seconds * 1000:.1f}ms (average {average * 1000:.1f}ms)")
+
+    def stats(self):
+        with self._lock:
+            return {kind: dict(timing) for kind, timing in self._timings.items()}
+
+@st.cache_resource
+def get_script_timings():
+    return ScriptTimings()
+
 def run_streamlit():
+    started = time.perf_counter()
+    st.session_state.full_run_active = True
+    try:
+        render_app()
+    finally:
+        st.session_state.full_run_active = False
+        get_script_timings().record('full', time.perf_counter() - started)
+
+def render_app():
     if 'messages' not in st.session_state:
         st.session_state.messages = []
+    if 'transcript_oldest_id' not in st.session_state:
+        st.session_state.transcript_oldest_id = None
+    if 'transcript_has_more' not in st.session_state:
+        st.session_state.transcript_has_more = False
+    if 'transcript_window' not in st.session_state:
+        st.session_state.transcript_window = CHAT_PAGE_SIZE
     if 'assistants' not in st.session_state:
         st.session_state.assistants = {}
     if 'selected_assistant' not in st.session_state:
@@ -122,8 +937,6 @@ def run_streamlit():
         st.session_state.uploaded_files = {}
     if 'share_files' not in st.session_state:
         st.session_state.share_files = False
-    if 'file_references' not in st.session_state:
-        st.session_state.file_references = {}
     if 'user_id' not in st.session_state:
         st.session_state.user_id = None
     if 'username' not in st.session_state:
@@ -132,19 +945,23 @@ def run_streamlit():
         st.session_state.file_info = {'assistants': {}, 'vision': {}}
     if 'pending_image_confirmation' not in st.session_state:
         st.session_state.pending_image_confirmation = None
-    if 'shared_files' not in st.session_state:
-        st.session_state.shared_files = set()
     if 'display_images' not in st.session_state:
         st.session_state.display_images = True
     if 'deleted_file_ids' not in st.session_state:
         st.session_state.deleted_file_ids = set()
+    if 'broadcast_assistants' not in st.session_state:
+        st.session_state.broadcast_assistants = []
+    if 'broadcast_threads' not in st.session_state:
+        st.session_state.broadcast_threads = {}
 
     login_sidebar()
     st.title("AI Assistant Solutions Beta")
 
     if is_user_logged_in():
         st.title(f"Welcome, {st.session_state.username}")
+        refresh_user_assistants()
         main_app()
+        save_session_state()
     else:
         st.warning("Please log in to access the application.")
 
@@ -176,14 +993,27 @@ def main_app():
 
         st.subheader("Select Assistants")
         assistant_options = list(st.session_state.assistants.keys())
+        selected_index = 0 if assistant_options else None
+        if st.session_state.selected_assistant in assistant_options:
+            # Restored from the state store, possibly set on another instance
+            selected_index = assistant_options.index(st.session_state.selected_assistant)
+        else:
+            # Deleted in another session; with no options left the selectbox would keep the stale name
+            st.session_state.selected_assistant = None
         selected_assistant = st.selectbox(
             "Select assistant to use",
             options=assistant_options,
-            index=0 if assistant_options else None
+            index=selected_index
         )
         if selected_assistant:
             st.session_state.selected_assistant = selected_assistant
 
+        # Drop selections for assistants that no longer exist before the widget reads its state
+        st.session_state.broadcast_assistants = [name for name in st.session_state.broadcast_assistants
+                                                 if name in st.session_state.assistants]
+        st.multiselect("Broadcast to several assistants (side-by-side replies)", options=assistant_options,
+                       key='broadcast_assistants')
+
         st.session_state.share_files = st.checkbox("Share files among assistants", value=st.session_state.share_files)
 
         uploaded_file = st.file_uploader("Upload a file for the assistant",
@@ -196,15 +1026,15 @@ def main_app():
                     file_id = file_info['id']
                     if st.session_state.share_files:
                         # If sharing is enabled, associate the file with all assistants
-                        st.session_state.shared_files.add(file_id)
-                        for assistant_name, assistant in st.session_state.assistants.items():
-                            if file_id not in assistant['file_ids']:
-                                new_file_ids = assistant['file_ids'] + [file_id]
-                                update_result = update_assistant_tool_resources(assistant['id'], new_file_ids)
-                                if update_result:
-                                    assistant['file_ids'] = new_file_ids
-                                    update_assistant_file_ids(st.session_state.user_id, assistant['id'], new_file_ids)
-                        st.success(f"File '{file_info['name']}' uploaded and shared with all assistants!")
+                        _, failed = bulk_update_assistant_files(st.session_state.assistants.values(), file_id,
+                                                                file_info['purpose'], attach=True, shared=True)
+                        if failed:
+                            failed_ids = {a['id'] for a in failed}
+                            failed_names = [name for name, a in st.session_state.assistants.items() if a['id'] in failed_ids]
+                            st.warning(f"File '{file_info['name']}' uploaded but could not be shared with: "
+                                       f"{', '.join(failed_names)}")
+                        else:
+                            st.success(f"File '{file_info['name']}' uploaded and shared with all assistants!")
                     else:
                         # If sharing is disabled, associate the file only with the selected assistant
                         assistant = st.session_state.assistants[st.session_state.selected_assistant]
@@ -213,17 +1043,13 @@ def main_app():
                             update_result = update_assistant_tool_resources(assistant['id'], new_file_ids)
                             if update_result:
                                 assistant['file_ids'] = new_file_ids
-                                update_assistant_file_ids(st.session_state.user_id, assistant['id'], new_file_ids)
+                                attach_file_to_assistant(assistant['id'], file_id, file_info['purpose'])
                                 st.success(
                                     f"File '{file_info['name']}' uploaded and attached to assistant '{st.session_state.selected_assistant}'!")
                             else:
                                 st.error("Failed to attach file to assistant.")
                         else:
                             st.warning(f"File '{file_info['name']}' is already associated with this assistant.")
-                    # Update file_references
-                    if file_id not in st.session_state.file_references:
-                        st.session_state.file_references[file_id] = {'count': 0,'shared': st.session_state.share_files}
-                    st.session_state.file_references[file_id]['count'] += len(st.session_state.assistants) if st.session_state.share_files else 1
 
                     st.session_state.uploaded_file_id = file_id
                     st.rerun()
@@ -252,49 +1078,68 @@ def main_app():
                     st.write(f"- {file_name}")
                 with col2:
                     if st.button("Remove", key=f"remove_{file_id}"):
-                        st.session_state.deleted_file_ids.add(file_id)
-
-                        if file_id not in st.session_state.file_references:
-                            st.session_state.file_references[file_id] = {'count': 0,
-                                                                         'shared': file_id in st.session_state.shared_files}
-
-                        st.session_state.file_references[file_id]['count'] -= 1
                         files_to_remove.append(file_id)
 
-                        if st.session_state.file_references[file_id]['shared']:
-                            if st.session_state.file_references[file_id]['count'] == 0:
-                                for asst in st.session_state.assistants.values():
-                                    if file_id in asst['file_ids']:
-                                        asst['file_ids'].remove(file_id)
-                                        update_assistant_tool_resources(asst['id'], asst['file_ids'])
-                                        update_assistant_file_ids(st.session_state.user_id, asst['id'],
-                                                                  asst['file_ids'])
-                                st.session_state.shared_files.remove(file_id)
-                                del st.session_state.file_references[file_id]
-                                for purpose in ['assistants', 'vision']:
-                                    if file_id in st.session_state.file_info[purpose]:
-                                        del st.session_state.file_info[purpose][file_id]
-                                st.success(f"Shared file '{file_name}' removed from all assistants.")
-                            else:
-                                st.success(
-                                    f"Shared file '{file_name}' removed from this assistant. Still in use by other assistants.")
-                        else:
-                            st.success(f"Non-shared file '{file_name}' removed from the assistant.")
-                            del st.session_state.file_references[file_id]
-                            for purpose in ['assistants', 'vision']:
-                                if file_id in st.session_state.file_info[purpose]:
-                                    del st.session_state.file_info[purpose][file_id]
-
             if files_to_remove:
-                st.session_state.deleted_file_ids.update(files_to_remove)
                 assistant['file_ids'] = [fid for fid in assistant['file_ids'] if fid not in files_to_remove]
                 update_assistant_tool_resources(assistant['id'], assistant['file_ids'])
-                update_assistant_file_ids(st.session_state.user_id, assistant['id'], assistant['file_ids'])
+                for file_id in files_to_remove:
+                    file_name = st.session_state.file_info['assistants'].get(file_id) or st.session_state.file_info[
+                        'vision'].get(file_id) or f"Unknown file (ID: {file_id})"
+                    shared = detach_file_from_assistant(assistant['id'], file_id)
+                    if shared and st.session_state.share_files:
+                        # With sharing on, removing a shared file removes it from every assistant
+                        _, failed = bulk_update_assistant_files(st.session_state.assistants.values(), file_id,
+                                                                attach=False)
+                        if failed:
+                            failed_ids = {a['id'] for a in failed}
+                            failed_names = [name for name, a in st.session_state.assistants.items() if a['id'] in failed_ids]
+                            st.warning(f"Shared file '{file_name}' removed from this assistant but could not be "
+                                       f"removed from: {', '.join(failed_names)}")
+                            continue
+                    if get_assistants_using_file(st.session_state.user_id, file_id):
+                        st.success(
+                            f"Shared file '{file_name}' removed from this assistant. Still in use by other assistants.")
+                        continue
+                    # No assistant references the file any more
+                    st.session_state.deleted_file_ids.add(file_id)
+                    enqueue_file_deletion(st.session_state.user_id, file_id)
+                    get_file_metadata_cache().invalidate(file_id)
+                    get_image_cache().invalidate(file_id)
+                    for purpose in ['assistants', 'vision']:
+                        if file_id in st.session_state.file_info[purpose]:
+                            del st.session_state.file_info[purpose][file_id]
+                    if shared:
+                        st.success(f"Shared file '{file_name}' removed from all assistants.")
+                    else:
+                        st.success(f"Non-shared file '{file_name}' removed from the assistant.")
                 st.rerun()
 
             if not assistant['file_ids']:
                 st.write("No files associated with this assistant.")
 
+            with st.expander(f"Run limits for {st.session_state.selected_assistant}"):
+                with st.form(f"run_settings_{assistant['id']}"):
+                    run_settings = assistant['run_settings']
+                    truncation_last_messages = st.number_input(
+                        "Only send the last N thread messages", min_value=1, step=1,
+                        value=run_settings['truncation_last_messages'])
+                    max_prompt_tokens = st.number_input(
+                        "Max prompt tokens per run", min_value=256, step=256, value=run_settings['max_prompt_tokens'])
+                    max_completion_tokens = st.number_input(
+                        "Max completion tokens per run", min_value=256, step=256,
+                        value=run_settings['max_completion_tokens'])
+                    st.caption("Leave a field empty for no limit.")
+                    if st.form_submit_button("Save run limits"):
+                        if update_assistant_run_settings(assistant, {
+                            'truncation_last_messages': truncation_last_messages,
+                            'max_prompt_tokens': max_prompt_tokens,
+                            'max_completion_tokens': max_completion_tokens,
+                        }):
+                            st.success("Run limits saved.")
+                        else:
+                            st.error("Failed to save run limits.")
+
         assistant_to_delete = st.selectbox("Select assistant to delete",
                                            options=[''] + list(st.session_state.assistants.keys()))
         if st.button("Delete Assistant") and assistant_to_delete:
@@ -302,7 +1147,10 @@ def main_app():
             response = delete_assistant(assistant_id)
             if response:
                 del st.session_state.assistants[assistant_to_delete]
-                remove_assistant_from_db(assistant_id)
+                for file_id in remove_assistant_from_db(assistant_id):
+                    st.session_state.deleted_file_ids.add(file_id)
+                    get_file_metadata_cache().invalidate(file_id)
+                    get_image_cache().invalidate(file_id)
                 st.success(f"Assistant '{assistant_to_delete}' deleted successfully!")
                 if st.session_state.selected_assistant == assistant_to_delete:
                     st.session_state.selected_assistant = None
@@ -318,6 +1166,7 @@ def main_app():
                 if response and hasattr(response, 'id'):
                     st.session_state.thread_id = response.id
                     update_user_thread_id(st.session_state.user_id, response.id)
+                    open_transcript(response.id)
                     st.success("New thread created successfully!")
                 else:
                     st.error("Error: Unable to create thread.")
@@ -329,44 +1178,29 @@ def main_app():
                 if response and hasattr(response, 'id'):
                     st.session_state.thread_id = response.id
                     update_user_thread_id(st.session_state.user_id, response.id)
+                    open_transcript(response.id)
                     st.success("New thread created successfully!")
                 else:
                     st.error("Error: Unable to create thread.")
                     logging.error(f"Error: {response}")
 
+        with st.expander("Run metrics"):
+            if st.button("Show run metrics"):
+                show_run_metrics()
+                show_instance_metrics()
+
         st.subheader("User Account Management")
         if st.button("Delete My Account"):
+            try:
+                get_state_store().delete_user(st.session_state.user_id)
+            except Exception as e:
+                logging.error(f"Error deleting session state for user {st.session_state.user_id}: {str(e)}")
             delete_user_account(st.session_state.username)
-            for key in ['user_id', 'thread_id', 'username', 'assistants', 'selected_assistant']:
-                if key in st.session_state:
-                    del st.session_state[key]
+            clear_user_session()
             st.success("Your account has been deleted.")
             st.rerun()
 
-    chat_container = st.container()
-
-    with chat_container:
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
-
-    if st.button("Clear Chat History"):
-        st.session_state.messages = []
-        st.rerun()
-
-    user_input_container = st.container()
-
-    with user_input_container:
-        user_message = st.chat_input("Type your message here...")
-
-        if user_message:
-            with chat_container.chat_message("user"):
-                st.markdown(user_message)
-
-            if st.session_state.selected_assistant:
-                run_message_stream(user_message, st.session_state.selected_assistant, chat_container)
-            else:
-                st.warning("Please select an assistant.")
+    chat_pane()
 
     st.markdown(
         """
@@ -378,71 +1212,756 @@ def main_app():
         unsafe_allow_html=True
     )
 
+CHAT_PAGE_SIZE = int(os.environ.get('CHAT_PAGE_SIZE', '20'))
+
+def load_transcript_page(thread_id, before_id=None, limit=CHAT_PAGE_SIZE):
+    # Returns up to limit messages older than before_id, oldest first
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            if before_id is None:
+                c.execute("""
+                    SELECT id, role, assistant_name, content FROM chat_messages
+                    WHERE thread_id = %s ORDER BY id DESC LIMIT %s
+                """, (thread_id, limit))
+            else:
+                c.execute("""
+                    SELECT id, role, assistant_name, content FROM chat_messages
+                    WHERE thread_id = %s AND id < %s ORDER BY id DESC LIMIT %s
+                """, (thread_id, before_id, limit))
+            rows = c.fetchall()
+    return list(reversed(rows))
+
+def save_transcript_messages(user_id, thread_id, messages):
+    # One transaction per chat turn; fills in each message's id
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            for message in messages:
+                c.execute("""
+                    INSERT INTO chat_messages (user_id, thread_id, role, assistant_name, content)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (user_id, thread_id, message['role'], message.get('assistant_name'), message['content']))
+                message['id'] = c.lastrowid
+        conn.commit()
+
+def open_transcript(thread_id):
+    # Only the most recent page is loaded; older pages come from load_earlier_messages()
+    page = load_transcript_page(thread_id)
+    st.session_state.messages = page
+    st.session_state.transcript_window = CHAT_PAGE_SIZE
+    st.session_state.transcript_oldest_id = page[0]['id'] if page else None
+    st.session_state.transcript_has_more = len(page) == CHAT_PAGE_SIZE
+
+def load_earlier_messages():
+    page = load_transcript_page(st.session_state.thread_id, st.session_state.transcript_oldest_id)
+    st.session_state.messages = page + st.session_state.messages
+    st.session_state.transcript_window += CHAT_PAGE_SIZE
+    if page:
+        st.session_state.transcript_oldest_id = page[0]['id']
+    st.session_state.transcript_has_more = len(page) == CHAT_PAGE_SIZE
+
+def record_chat_turn(user_message, replies):
+    # replies: [(assistant_name, text)]; persists the turn and keeps the rendered window bounded
+    turn = [{'role': 'user', 'content': user_message}]
+    turn += [{'role': 'assistant', 'assistant_name': name, 'content': text} for name, text in replies]
+    if st.session_state.thread_id:
+        try:
+            save_transcript_messages(st.session_state.user_id, st.session_state.thread_id, turn)
+        except Exception as e:
+            logging.error(f"Error saving chat transcript: {str(e)}")
+    messages = st.session_state.messages + turn
+    if len(messages) > st.session_state.transcript_window:
+        messages = messages[-st.session_state.transcript_window:]
+        if messages[0].get('id'):
+            st.session_state.transcript_oldest_id = messages[0]['id']
+            st.session_state.transcript_has_more = True
+    st.session_state.messages = messages
+
+@st.fragment
+def chat_pane():
+    # Sending or streaming a message reruns only this fragment, not the sidebar or login widgets
+    started = time.perf_counter()
+    try:
+        # Above the history it prepends to
+        if st.session_state.transcript_has_more and st.button("Load earlier messages"):
+            load_earlier_messages()
+            st.rerun(scope="fragment")
+
+        chat_container = st.container()
+
+        with chat_container:
+            for message in st.session_state.messages:
+                with st.chat_message(message["role"]):
+                    if message.get("assistant_name"):
+                        st.write(f"Response from {message['assistant_name']}:")
+                    st.markdown(message["content"])
+
+        if st.button("Clear Chat History"):
+            st.session_state.messages = []
+            st.session_state.transcript_oldest_id = None
+            st.session_state.transcript_has_more = False
+            st.session_state.transcript_window = CHAT_PAGE_SIZE
+            st.rerun(scope="fragment")
+
+        user_input_container = st.container()
+
+        with user_input_container:
+            user_message = st.chat_input("Type your message here...")
+
+            if user_message:
+                with chat_container.chat_message("user"):
+                    st.markdown(user_message)
+
+                if len(st.session_state.broadcast_assistants) > 1:
+                    run_broadcast(user_message, st.session_state.broadcast_assistants, chat_container)
+                elif st.session_state.selected_assistant:
+                    run_message_stream(user_message, st.session_state.selected_assistant, chat_container)
+                else:
+                    st.warning("Please select an assistant.")
+    finally:
+        if not st.session_state.get('full_run_active'):
+            get_script_timings().record('chat_fragment', time.perf_counter() - started)
+
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR')  # Disk tier is off unless set
+IMAGE_CACHE_DISK_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))
+IMAGE_THUMBNAIL_EDGE = int(os.environ.get('IMAGE_THUMBNAIL_EDGE', '640'))
+THUMBNAIL_SUFFIX = '_thumb'
+IMAGE_MIME_TYPES = {'PNG': 'image/png', 'JPEG': 'image/jpeg', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+
+class ImageCache:
+    # LRU of display-ready image bytes (full size and thumbnail) keyed by file_id, with an optional
+    # size-capped disk tier
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self._max_bytes = max_bytes
+        self._disk_dir = disk_dir
+        self._disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, file_id):
+        if not self._disk_dir or not re.fullmatch(r'[A-Za-z0-9_-]+', file_id):
+            return None
+        return os.path.join(self._disk_dir, f"{file_id}.png")
+
+    def get(self, file_id):
+        with self._lock:
+            if file_id in self._entries:
+                self._entries.move_to_end(file_id)
+                self._stats['hits'] += 1
+                return self._entries[file_id]
+        path = self._disk_path(file_id)
+        if path:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)  # Disk eviction is least-recently-used by mtime
+                self._put_memory(file_id, data)
+                with self._lock:
+                    self._stats['disk_hits'] += 1
+                return data
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning(f"Error reading cached image {path}: {str(e)}")
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def put(self, file_id, data):
+        self._put_memory(file_id, data)
+        path = self._disk_path(file_id)
+        if path:
+            try:
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._evict_disk()
+            except OSError as e:
+                logging.warning(f"Error writing cached image {path}: {str(e)}")
+
+    def invalidate(self, file_id):
+        for key in (file_id, f"{file_id}{THUMBNAIL_SUFFIX}"):
+            with self._lock:
+                data = self._entries.pop(key, None)
+                if data is not None:
+                    self._size -= len(data)
+            path = self._disk_path(key)
+            if path:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._size)
+
+    def _put_memory(self, file_id, data):
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(file_id, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[file_id] = data
+            self._size += len(data)
+            while self._size > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._stats['evictions'] += 1
+
+    def _evict_disk(self):
+        files = []
+        for entry in os.scandir(self._disk_dir):
+            if entry.is_file() and entry.name.endswith('.png'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self._disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+@st.cache_resource
+def get_image_cache():
+    # Shared by every session in the process
+    return ImageCache(IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_DIR, IMAGE_CACHE_DISK_MAX_BYTES)
+
+def image_mime_type(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+def make_display_images(file_content):
+    # Returns (full_bytes, thumbnail_bytes). Browser-ready images that need no rotation are passed through
+    # untouched; only EXIF-rotated or unusual formats are decoded and re-encoded to PNG.
+    image = Image.open(io.BytesIO(file_content))
+    # draft() changes image.size to the reduced decode size, so decide on the size as stored
+    original_size = image.size
+    if image.getexif().get(274, 1) == 1 and image.format in IMAGE_MIME_TYPES:  # 274 is the orientation tag
+        full_bytes = file_content
+        if image.format == 'JPEG' and max(original_size) > IMAGE_THUMBNAIL_EDGE:
+            # Only the thumbnail is decoded, so libjpeg can scale down while decoding
+            image.draft('RGB', (IMAGE_THUMBNAIL_EDGE, IMAGE_THUMBNAIL_EDGE))
+    else:
+        image = ImageOps.exif_transpose(image)
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        full_bytes = output.getvalue()
+
+    if max(original_size) <= IMAGE_THUMBNAIL_EDGE:
+        return full_bytes, full_bytes
+    image.thumbnail((IMAGE_THUMBNAIL_EDGE, IMAGE_THUMBNAIL_EDGE), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image.save(output, format='PNG', optimize=True)
+    else:
+        image.convert('RGB').save(output, format='JPEG', quality=85)
+    return full_bytes, output.getvalue()
+
+def load_display_image(file_id, image_cache):
+    # Returns (status_code, (full_bytes, thumbnail_bytes)); a cache hit needs no download and no decode
+    thumbnail_key = f"{file_id}{THUMBNAIL_SUFFIX}"
+    cached_thumbnail = image_cache.get(thumbnail_key)
+    cached_full = image_cache.get(file_id) if cached_thumbnail is not None else None
+    if cached_full is not None:
+        logger.debug(f"Image cache hit for file_id: {file_id}")
+        return 200, (cached_full, cached_thumbnail)
+
+    logger.debug(f"Sending GET request for content of file_id: {file_id}")
+    response = openai_api_get(f"files/{file_id}/content")
+    logger.debug(f"Response status code: {response.status_code}")
+    if response.status_code != 200:
+        return response.status_code, None
+    logger.debug(f"Successfully retrieved file content for file_id: {file_id}")
+
+    full_bytes, thumbnail_bytes = make_display_images(response.content)
+    image_cache.put(file_id, full_bytes)
+    image_cache.put(thumbnail_key, thumbnail_bytes)
+    return 200, (full_bytes, thumbnail_bytes)
+
+def render_image(file_id, images, filename="image.png"):
+    # The chat only carries the thumbnail; full resolution is fetched by the browser on download
+    full_bytes, thumbnail_bytes = images
+    st.image(thumbnail_bytes, caption=filename)
+    logger.debug(f"Displayed image thumbnail for file_id: {file_id}")
+
+    # Create a unique key for each download button
+    unique_key = f"download_button_{file_id}_{int(time.time())}"
+
+    mime_type = image_mime_type(full_bytes)
+    extension = mime_type.split('/')[-1].replace('jpeg', 'jpg')
+    download_button = st.download_button(
+        label="Download full-size image",
+        data=full_bytes,
+        file_name=f"{filename.rsplit('.', 1)[0]}.{extension}",
+        mime=mime_type,
+        key=unique_key
+    )
+    logger.debug(f"Created download button for file_id: {file_id} with key: {unique_key}")
+
+    if download_button:
+        logger.debug(f"Download button clicked for file_id: {file_id}")
+
+IMAGE_FETCH_WORKERS = int(os.environ.get('IMAGE_FETCH_WORKERS', '4'))
+IMAGE_FETCH_TIMEOUT = float(os.environ.get('IMAGE_FETCH_TIMEOUT', '30'))
+
+@st.cache_resource
+def get_image_executor():
+    return ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS, thread_name_prefix='image-fetch')
+
+def render_image_result(file_id, status_code, images, filename="image.png"):
+    if status_code == 200:
+        render_image(file_id, images, filename)
+    elif status_code == 404:
+        logger.error(f"File not found. File ID: {file_id}")
+        st.error("File not found. Please check the file ID or upload a new file.")
+    else:
+        logger.error(f"Failed to retrieve image. Status code: {status_code}, File ID: {file_id}")
+        st.error(f"Could not retrieve the image. Status code: {status_code}")
+
 def display_or_download_image(file_id, filename="image.png"):
     if not st.session_state.display_images:
         return
 
     logger.debug(f"Attempting to display or download image with file_id: {file_id}")
     try:
-        api_url = f"https://api.openai.com/v1/files/{file_id}/content"
-        headers = {"Authorization": f"Bearer {openai.api_key}"}
-        logger.debug(f"Sending GET request to: {api_url}")
-        response = requests.get(api_url, headers=headers)
-        logger.debug(f"Response status code: {response.status_code}")
-
-        if response.status_code == 200:
-            file_content = response.content
-            logger.debug(f"Successfully retrieved file content for file_id: {file_id}")
-
-            # Open the image using Pillow
-            image = Image.open(io.BytesIO(file_content))
-
-            # Correct orientation if needed
-            if hasattr(image, '_getexif'):  # Only present in JPEGs
-                exif = image._getexif()
-                if exif:
-                    orientation = exif.get(274, 1)  # 274 is the orientation tag
-                    if orientation == 3:
-                        image = image.rotate(180, expand=True)
-                    elif orientation == 6:
-                        image = image.rotate(270, expand=True)
-                    elif orientation == 8:
-                        image = image.rotate(90, expand=True)
-
-            # Convert the image back to bytes
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
-
-            # Display the corrected image
-            st.image(img_byte_arr, caption=filename, use_column_width=True)
-            logger.debug(f"Displayed image for file_id: {file_id}")
-
-            # Create a unique key for each download button
-            unique_key = f"download_button_{file_id}_{int(time.time())}"
-
-            download_button = st.download_button(
-                label="Download image",
-                data=img_byte_arr,
-                file_name=filename,
-                mime="image/png",
-                key=unique_key
-            )
-            logger.debug(f"Created download button for file_id: {file_id} with key: {unique_key}")
-
-            if download_button:
-                logger.debug(f"Download button clicked for file_id: {file_id}")
-        elif response.status_code == 404:
-            logger.error(f"File not found. File ID: {file_id}")
-            st.error("File not found. Please check the file ID or upload a new file.")
-            return
-        else:
-            logger.error(f"Failed to retrieve image. Status code: {response.status_code}, File ID: {file_id}")
-            st.error(f"Could not retrieve the image. Status code: {response.status_code}")
+        status_code, images = load_display_image(file_id, get_image_cache())
+        render_image_result(file_id, status_code, images, filename)
     except Exception as e:
         logger.exception(f"Error in display_or_download_image for file_id {file_id}: {str(e)}")
         st.error("Failed to display or download the image. Please try again later.")
 
+def display_images(file_ids):
+    if not st.session_state.display_images or not file_ids:
+        return
+
+    # Download and decode on the pool; render on the script thread in the original order
+    image_cache = get_image_cache()
+    executor = get_image_executor()
+    started = time.monotonic()
+    futures = [(file_id, submit_as_user(executor, load_display_image, file_id, image_cache)) for file_id in file_ids]
+    failures = 0
+    for file_id, future in futures:
+        try:
+            status_code, images = future.result(timeout=max(0.0, started + IMAGE_FETCH_TIMEOUT - time.monotonic()))
+            render_image_result(file_id, status_code, images)
+            failures += status_code != 200
+        except FuturesTimeoutError:
+            future.cancel()
+            failures += 1
+            logger.error(f"Timed out after {IMAGE_FETCH_TIMEOUT}s loading image {file_id}")
+            st.error("Timed out loading an image. Please try again later.")
+        except Exception as e:
+            failures += 1
+            logger.exception(f"Error loading image {file_id}: {str(e)}")
+            st.error("Failed to display or download the image. Please try again later.")
+    logging.info(f"Displayed {len(file_ids) - failures}/{len(file_ids)} images in {time.monotonic() - started:.2f}s")
+
+class RunEventHandler(AssistantEventHandler):
+    # Collects image outputs from the stream of a single run
+    def __init__(self):
+        super().__init__()
+        self.image_file_ids = []
+        self.completed_messages = 0
+        self.started_at = time.monotonic()
+        self.in_progress_at = None
+        self.first_token_at = None
+
+    def on_event(self, event):
+        if event.event == 'thread.run.in_progress' and self.in_progress_at is None:
+            self.in_progress_at = time.monotonic()
+
+    def on_text_delta(self, delta, snapshot):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+    def elapsed(self, timestamp):
+        return timestamp - self.started_at if timestamp is not None else None
+
+    def _add_image_file(self, file_id):
+        if file_id not in self.image_file_ids:
+            self.image_file_ids.append(file_id)
+
+    def on_image_file_done(self, image_file):
+        self._add_image_file(image_file.file_id)
+
+    def on_message_done(self, message):
+        self.completed_messages += 1
+        for content in message.content:
+            if content.type == 'image_file':
+                self._add_image_file(content.image_file.file_id)
+
+async def async_list_run_image_file_ids(thread_id, run_id):
+    image_file_ids = []
+    async for message in aclient.beta.threads.messages.list(thread_id=thread_id, run_id=run_id, order='asc'):
+        for content in message.content:
+            if content.type == 'image_file' and content.image_file.file_id not in image_file_ids:
+                image_file_ids.append(content.image_file.file_id)
+    return image_file_ids
+
+def list_run_image_file_ids(thread_id, run_id):
+    return run_openai(async_list_run_image_file_ids, thread_id, run_id)
+
+STREAM_FLUSH_MS = float(os.environ.get('STREAM_FLUSH_MS', '50'))
+STREAM_FLUSH_CHARS = int(os.environ.get('STREAM_FLUSH_CHARS', '256'))
+
+class StreamMetrics:
+    # Process-wide counters for rendered stream frames
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {'streams': 0, 'deltas': 0, 'frames': 0, 'bytes': 0, 'first_token_seconds_total': 0.0}
+
+    def record(self, deltas, frames, sent_bytes, first_token_seconds):
+        with self._lock:
+            self._stats['streams'] += 1
+            self._stats['deltas'] += deltas
+            self._stats['frames'] += frames
+            self._stats['bytes'] += sent_bytes
+            self._stats['first_token_seconds_total'] += first_token_seconds or 0.0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        streams = stats['streams']
+        stats['first_token_seconds_avg'] = stats['first_token_seconds_total'] / streams if streams else 0.0
+        stats['deltas_per_frame'] = stats['deltas'] / stats['frames'] if stats['frames'] else 0.0
+        return stats
+
+@st.cache_resource
+def get_stream_metrics():
+    return StreamMetrics()
+
+def coalesce_deltas(deltas, flush_ms=STREAM_FLUSH_MS, flush_chars=STREAM_FLUSH_CHARS, label='stream'):
+    # Batch tiny text deltas so each yield (one Markdown re-render and websocket frame) carries more text.
+    # The first delta goes out immediately to keep time-to-first-token unchanged.
+    started = time.monotonic()
+    first_token_seconds = None
+    buffer = []
+    buffered_chars = 0
+    last_flush = started
+    delta_count = frame_count = sent_bytes = 0
+    for delta in deltas:
+        delta_count += 1
+        buffer.append(delta)
+        buffered_chars += len(delta)
+        now = time.monotonic()
+        if first_token_seconds is None:
+            first_token_seconds = now - started
+        if frame_count and buffered_chars < flush_chars and (now - last_flush) * 1000 < flush_ms:
+            continue
+        chunk = ''.join(buffer)
+        buffer, buffered_chars, last_flush = [], 0, now
+        frame_count += 1
+        sent_bytes += len(chunk.encode('utf-8'))
+        yield chunk
+    if buffer:
+        chunk = ''.join(buffer)
+        frame_count += 1
+        sent_bytes += len(chunk.encode('utf-8'))
+        yield chunk
+    get_stream_metrics().record(delta_count, frame_count, sent_bytes, first_token_seconds)
+    logging.info(f"{label}: {delta_count} deltas in {frame_count} frames ({sent_bytes} bytes), "
+                 f"first token {first_token_seconds or 0:.2f}s")
+
+RUN_SETTINGS = ['truncation_last_messages', 'max_prompt_tokens', 'max_completion_tokens']
+
+def update_assistant_run_settings(assistant, run_settings):
+    run_settings = {setting: int(value) if value is not None else None for setting, value in run_settings.items()}
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute("""
+                    UPDATE user_assistants
+                    SET truncation_last_messages = %s, max_prompt_tokens = %s, max_completion_tokens = %s,
+                        state_version = state_version + 1
+                    WHERE assistant_id = %s
+                """, (run_settings['truncation_last_messages'], run_settings['max_prompt_tokens'],
+                      run_settings['max_completion_tokens'], assistant['id']))
+            conn.commit()
+    except Exception as e:
+        logging.error(f"Error saving run settings for assistant {assistant['id']}: {str(e)}")
+        return False
+    assistant['run_settings'] = run_settings
+    return True
+
+def run_options(assistant):
+    # Extra runs.stream arguments that bound how much context and output a run may use
+    run_settings = assistant.get('run_settings') or {}
+    options = {}
+    if run_settings.get('truncation_last_messages'):
+        options['truncation_strategy'] = {'type': 'last_messages',
+                                          'last_messages': run_settings['truncation_last_messages']}
+    if run_settings.get('max_prompt_tokens'):
+        options['max_prompt_tokens'] = run_settings['max_prompt_tokens']
+    if run_settings.get('max_completion_tokens'):
+        options['max_completion_tokens'] = run_settings['max_completion_tokens']
+    return options
+
+def format_usage(usage):
+    if usage is None:
+        return "Token usage unavailable"
+    return (f"Tokens: {usage.prompt_tokens} prompt, {usage.completion_tokens} completion, "
+            f"{usage.total_tokens} total")
+
+RUN_METRICS_BATCH_SIZE = int(os.environ.get('RUN_METRICS_BATCH_SIZE', '50'))
+RUN_METRICS_FLUSH_SECONDS = float(os.environ.get('RUN_METRICS_FLUSH_SECONDS', '5'))
+RUN_METRICS_MAX_BUFFER = int(os.environ.get('RUN_METRICS_MAX_BUFFER', '10000'))
+RUN_METRICS_SUMMARY_DAYS = int(os.environ.get('RUN_METRICS_SUMMARY_DAYS', '30'))
+
+RUN_METRICS_COLUMNS = ['user_id', 'assistant_id', 'thread_id', 'run_id', 'status', 'prompt_tokens',
+                       'completion_tokens', 'total_tokens', 'queue_seconds', 'first_token_seconds',
+                       'total_seconds', 'image_seconds']
+
+class RunMetricsWriter:
+    # Buffers per-run metrics in memory and inserts them in batches from a background thread
+    def __init__(self):
+        self._buffer = queue.Queue(maxsize=RUN_METRICS_MAX_BUFFER)
+        self._thread = threading.Thread(target=self._run, name='run-metrics', daemon=True)
+        self._lock = threading.Lock()
+        self._metrics = {'recorded': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'write_errors': 0}
+
+    def start(self):
+        self._thread.start()
+
+    def record(self, user_id, assistant_id, thread_id, run=None, **timings):
+        usage = run.usage if run is not None else None
+        row = {
+            'user_id': user_id,
+            'assistant_id': assistant_id,
+            'thread_id': thread_id,
+            'run_id': run.id if run is not None else None,
+            'status': run.status if run is not None else None,
+            'prompt_tokens': usage.prompt_tokens if usage else None,
+            'completion_tokens': usage.completion_tokens if usage else None,
+            'total_tokens': usage.total_tokens if usage else None,
+        }
+        for column in ['queue_seconds', 'first_token_seconds', 'total_seconds', 'image_seconds']:
+            row[column] = timings.get(column)
+        try:
+            # Never block the chat on metrics; drop when the writer has fallen behind
+            self._buffer.put_nowait(tuple(row[column] for column in RUN_METRICS_COLUMNS))
+            with self._lock:
+                self._metrics['recorded'] += 1
+        except queue.Full:
+            with self._lock:
+                self._metrics['dropped'] += 1
+            logging.warning(f"Run metrics buffer full, dropped metrics for run {row['run_id']}")
+
+    def _run(self):
+        while True:
+            rows = []
+            deadline = time.monotonic() + RUN_METRICS_FLUSH_SECONDS
+            while len(rows) < RUN_METRICS_BATCH_SIZE:
+                try:
+                    rows.append(self._buffer.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if rows:
+                self._write(rows)
+
+    def _write(self, rows):
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as c:
+                    c.executemany(f"""
+                        INSERT INTO run_metrics ({', '.join(RUN_METRICS_COLUMNS)})
+                        VALUES ({', '.join(['%s'] * len(RUN_METRICS_COLUMNS))})
+                    """, rows)
+                conn.commit()
+            with self._lock:
+                self._metrics['written'] += len(rows)
+                self._metrics['batches'] += 1
+        except Exception as e:
+            with self._lock:
+                self._metrics['write_errors'] += 1
+                self._metrics['dropped'] += len(rows)
+            logging.error(f"Error writing {len(rows)} run metrics: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+        stats['buffered'] = self._buffer.qsize()
+        return stats
+
+@st.cache_resource
+def get_run_metrics_writer():
+    writer = RunMetricsWriter()
+    writer.start()
+    return writer
+
+def percentile(values, pct):
+    # Nearest-rank percentile of the non-null values
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, -(-len(values) * pct // 100) - 1))]
+
+def get_run_metrics_summary(user_id, days=RUN_METRICS_SUMMARY_DAYS):
+    # Per-assistant latency percentiles and token spend, plus the most expensive threads
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute("""
+                    SELECT assistant_id, thread_id, total_tokens, prompt_tokens, completion_tokens,
+                           queue_seconds, first_token_seconds, total_seconds, image_seconds
+                    FROM run_metrics
+                    WHERE user_id = %s AND created_at >= NOW() - INTERVAL %s DAY
+                """, (user_id, days))
+                rows = c.fetchall()
+    except Exception as e:
+        logging.error(f"Error loading run metrics for user {user_id}: {str(e)}")
+        return None
+
+    by_assistant = {}
+    by_thread = {}
+    for row in rows:
+        by_assistant.setdefault(row['assistant_id'], []).append(row)
+        thread = by_thread.setdefault((row['assistant_id'], row['thread_id']), {'runs': 0, 'total_tokens': 0})
+        thread['runs'] += 1
+        thread['total_tokens'] += row['total_tokens'] or 0
+
+    assistants = []
+    for assistant_id, assistant_rows in by_assistant.items():
+        summary = {
+            'assistant_id': assistant_id,
+            'runs': len(assistant_rows),
+            'prompt_tokens': sum(row['prompt_tokens'] or 0 for row in assistant_rows),
+            'completion_tokens': sum(row['completion_tokens'] or 0 for row in assistant_rows),
+            'total_tokens': sum(row['total_tokens'] or 0 for row in assistant_rows),
+        }
+        for column in ['queue_seconds', 'first_token_seconds', 'total_seconds', 'image_seconds']:
+            values = [row[column] for row in assistant_rows]
+            summary[f"{column.replace('_seconds', '')}_p50"] = percentile(values, 50)
+            summary[f"{column.replace('_seconds', '')}_p95"] = percentile(values, 95)
+        assistants.append(summary)
+    assistants.sort(key=lambda summary: summary['total_tokens'], reverse=True)
+
+    threads = [{'assistant_id': assistant_id, 'thread_id': thread_id, **thread}
+               for (assistant_id, thread_id), thread in by_thread.items()]
+    threads.sort(key=lambda thread: thread['total_tokens'], reverse=True)
+    return {'assistants': assistants, 'threads': threads[:10]}
+
+def show_run_metrics():
+    summary = get_run_metrics_summary(st.session_state.user_id)
+    if summary is None:
+        st.error("Failed to load run metrics.")
+        return
+    if not summary['assistants']:
+        st.write("No runs recorded yet.")
+        return
+    names = {assistant['id']: name for name, assistant in st.session_state.assistants.items()}
+    for row in summary['assistants'] + summary['threads']:
+        row['assistant'] = names.get(row['assistant_id'], row['assistant_id'])
+    st.write(f"Per assistant, last {RUN_METRICS_SUMMARY_DAYS} days (seconds)")
+    st.dataframe([{key: value for key, value in row.items() if key != 'assistant_id'}
+                  for row in summary['assistants']])
+    st.write("Most expensive threads")
+    st.dataframe([{key: value for key, value in row.items() if key != 'assistant_id'}
+                  for row in summary['threads']])
+
+def get_instance_metrics():
+    # Process-wide counters from the shared pools, caches and workers on this instance
+    return {
+        'openai_scheduler': openai_service.stats(),
+        'db_pool': db_pool.stats(),
+        'image_cache': get_image_cache().stats(),
+        'file_metadata_cache': get_file_metadata_cache().stats(),
+        'file_gc': get_file_gc_worker().stats(),
+        'run_metrics_writer': get_run_metrics_writer().stats(),
+        'password_hash_pool': get_password_hash_pool().stats(),
+    }
+
+def show_instance_metrics():
+    st.write("This instance (all users)")
+    for name, stats in get_instance_metrics().items():
+        st.caption(name)
+        st.json(stats, expanded=False)
+
+def split_message_files(assistant):
+    # Returns (image_file_ids, code_interpreter_file_ids) among the assistant's files still on the server
+    image_file_ids = []
+    file_ids_for_code_interpreter = []
+
+    logging.info(f"Assistant file_ids: {assistant['file_ids']}")
+
+    # Identify file IDs for vision and code interpreter purposes
+    assistant_file_ids = assistant['file_ids']
+    files_on_server = check_files_exist_on_server(assistant_file_ids)
+    for file_id in assistant_file_ids:
+        logging.info(f"Checking file_id: {file_id}")
+        if files_on_server[file_id]:
+            if file_id in st.session_state.file_info['vision']:
+                image_file_ids.append(file_id)
+                logging.info(f"Added {file_id} to image_file_ids")
+            elif file_id in st.session_state.file_info['assistants']:
+                file_ids_for_code_interpreter.append(file_id)
+                logging.info(f"Added {file_id} to file_ids_for_code_interpreter")
+        else:
+            logging.warning(f"File with ID {file_id} is marked as deleted. Skipping.")
+
+    logging.info(f"image_file_ids: {image_file_ids}")
+    logging.info(f"file_ids_for_code_interpreter: {file_ids_for_code_interpreter}")
+    return image_file_ids, file_ids_for_code_interpreter
+
+def message_content_with_images(user_message, image_file_ids):
+    message_content = [{"type": "text", "text": user_message}]
+    for image_file_id in image_file_ids:
+        message_content.append({"type": "image_file", "image_file": {"file_id": image_file_id}})
+    logging.info(f"Final message_content: {message_content}")
+    return message_content
+
+def build_message_content(assistant, user_message):
+    # Returns the user message content with the assistant's images attached, or None if its
+    # code interpreter files could not be applied
+    image_file_ids, file_ids_for_code_interpreter = split_message_files(assistant)
+
+    # Update assistant with file_ids for code interpreter
+    if file_ids_for_code_interpreter:
+        logging.info("Updating assistant with code interpreter file IDs")
+        updated_assistant = update_assistant_tool_resources(assistant['id'], file_ids_for_code_interpreter)
+        if updated_assistant is None:
+            logging.error("Failed to update assistant with new file resources.")
+            return None
+        logging.info("Assistant updated successfully")
+
+    return message_content_with_images(user_message, image_file_ids)
+
+def open_run_stream(thread_id, assistant_id, options):
+    # Sync counterpart of async_open_run_stream: returns (manager, event handler) once the run has started.
+    # Starting is scheduled and retried like AsyncOpenAIService.call; the caller reads the stream and must
+    # __exit__ the manager.
+    for attempt in range(OPENAI_RETRY_ATTEMPTS + 1):
+        # A fresh manager and handler per attempt; the handler clock starts here so queue time covers run creation
+        manager = client.beta.threads.runs.stream(
+            thread_id=thread_id, assistant_id=assistant_id, event_handler=RunEventHandler(),
+            timeout=httpx.Timeout(OPENAI_STREAM_TIMEOUT, connect=OPENAI_HTTP_CONNECT_TIMEOUT), **options)
+        try:
+            with openai_service.slot():
+                return manager, manager.__enter__()
+        except OPENAI_RETRYABLE_ERRORS as e:
+            if attempt == OPENAI_RETRY_ATTEMPTS:
+                raise
+            delay = retry_delay(attempt, getattr(e, 'response', None))
+            openai_service.retrying(delay, isinstance(e, openai.RateLimitError))
+            logging.warning(f"Starting run on thread {thread_id} failed ({str(e)}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
 def run_message_stream(user_message, selected_assistant, chat_container):
     try:
         thread_id = st.session_state.thread_id
@@ -451,47 +1970,15 @@ def run_message_stream(user_message, selected_assistant, chat_container):
         logging.info(f"Starting run_message_stream with thread_id: {thread_id}, assistant_id: {assistant_id}")
         logging.info(f"display_images setting: {st.session_state.display_images}")
 
-        message_content = [{"type": "text", "text": user_message}]
-        image_file_ids = []
-        file_ids_for_code_interpreter = []
-
         logging.info(f"User message: {user_message}")
-        logging.info(f"Assistant file_ids: {st.session_state.assistants[selected_assistant]['file_ids']}")
-
-        # Identify file IDs for vision and code interpreter purposes
-        for file_id in st.session_state.assistants[selected_assistant]['file_ids']:
-            logging.info(f"Checking file_id: {file_id}")
-            if check_file_exists_on_server(file_id):
-                if file_id in st.session_state.file_info['vision']:
-                    image_file_ids.append(file_id)
-                    logging.info(f"Added {file_id} to image_file_ids")
-                elif file_id in st.session_state.file_info['assistants']:
-                    file_ids_for_code_interpreter.append(file_id)
-                    logging.info(f"Added {file_id} to file_ids_for_code_interpreter")
-            else:
-                logging.warning(f"File with ID {file_id} is marked as deleted. Skipping.")
-
-        logging.info(f"image_file_ids: {image_file_ids}")
-        logging.info(f"file_ids_for_code_interpreter: {file_ids_for_code_interpreter}")
-
-        # Update assistant with file_ids for code interpreter
-        if file_ids_for_code_interpreter:
-            logging.info("Updating assistant with code interpreter file IDs")
-            updated_assistant = update_assistant_tool_resources(assistant_id, file_ids_for_code_interpreter)
-            if updated_assistant is None:
-                logging.error("Failed to update assistant with new file resources.")
-                st.error("Failed to update assistant with new file resources.")
-                return
-            logging.info("Assistant updated successfully")
-
-        # Add image file IDs to the message content
-        for image_file_id in image_file_ids:
-            message_content.append({"type": "image_file", "image_file": {"file_id": image_file_id}})
-
-        logging.info(f"Final message_content: {message_content}")
+        message_content = build_message_content(st.session_state.assistants[selected_assistant], user_message)
+        if message_content is None:
+            st.error("Failed to update assistant with new file resources.")
+            return
 
         # Create the message in the thread
-        created_message = client.beta.threads.messages.create(
+        created_message = run_openai(
+            aclient.beta.threads.messages.create,
             thread_id=thread_id,
             role="user",
             content=message_content
@@ -501,64 +1988,258 @@ def run_message_stream(user_message, selected_assistant, chat_container):
         # Stream the assistant's response
         with chat_container.chat_message("assistant"):
             st.write(f"Response from {selected_assistant}:")
-            with client.beta.threads.runs.stream(
-                    thread_id=thread_id,
-                    assistant_id=assistant_id,
-            ) as stream:
-                st.write_stream(stream.text_deltas)
-                stream.until_done()
+            with openai_service.stream_slot():
+                manager, event_handler = open_run_stream(
+                    thread_id, assistant_id, run_options(st.session_state.assistants[selected_assistant]))
+                try:
+                    response_text = st.write_stream(coalesce_deltas(event_handler.text_deltas,
+                                                                    label=f"Stream from {selected_assistant}"))
+                    event_handler.until_done()
+                finally:
+                    manager.__exit__(None, None, None)
+            total_seconds = event_handler.elapsed(time.monotonic())
+            usage = event_handler.current_run.usage if event_handler.current_run else None
+            if usage:
+                openai_service.charge_tokens(usage.total_tokens)
+            st.caption(format_usage(usage))
+            logging.info(f"Run usage for {selected_assistant}: {usage}")
+        record_chat_turn(user_message, [(selected_assistant, response_text)])
 
         logging.info("Assistant response streaming completed")
 
-        # Check for image output in the response
+        # Check for image output produced by this run only
         logging.info(f"Checking for image output. display_images: {st.session_state.display_images}")
+        image_started = time.monotonic()
         if st.session_state.display_images:
-            logging.info("Display images is True, proceeding to check for image output")
-            messages = client.beta.threads.messages.list(thread_id=thread_id)
-            logging.info(f"Retrieved {len(messages.data)} messages from the thread")
-            displayed_files = set()  # Keep track of displayed files
-            for message in messages.data:
-                for content in message.content:
-                    logging.info(f"Content type: {content.type}")
-                    if content.type == 'image_file':
-                        file_id = content.image_file.file_id
-                        logging.info(f"Found image file with ID: {file_id}")
-                        if file_id not in displayed_files and check_file_exists(file_id):
-                            logging.info(f"Displaying image: {file_id}")
-                            display_or_download_image(file_id)
-                            displayed_files.add(file_id)  # Mark as displayed
-                        elif file_id in st.session_state.deleted_file_ids:
-                            logging.warning(f"File with ID {file_id} has been removed and cannot be displayed.")
-                        else:
-                            logging.warning(f"File with ID {file_id} has already been displayed.")
+            image_output_ids = event_handler.image_file_ids
+            if not event_handler.completed_messages and event_handler.current_run:
+                # The stream ended before any message.completed event; ask for this run's messages only
+                image_output_ids = list_run_image_file_ids(thread_id, event_handler.current_run.id)
+            logging.info(f"Run produced {len(image_output_ids)} image file(s)")
+            displayable_ids = []
+            for file_id in image_output_ids:
+                if check_file_exists(file_id):
+                    displayable_ids.append(file_id)
+                else:
+                    logging.warning(f"File with ID {file_id} has been removed and cannot be displayed.")
+            display_images(displayable_ids)
         else:
             logging.info("Display images is False, skipping image output check")
+        get_run_metrics_writer().record(
+            st.session_state.user_id, assistant_id, thread_id, event_handler.current_run,
+            queue_seconds=event_handler.elapsed(event_handler.in_progress_at),
+            first_token_seconds=event_handler.elapsed(event_handler.first_token_at),
+            total_seconds=total_seconds,
+            image_seconds=time.monotonic() - image_started if st.session_state.display_images else None)
 
         logging.info("run_message_stream completed successfully")
     except Exception as e:
         logging.error(f"Error during message stream: {str(e)}", exc_info=True)
         st.error("An error occurred during the message stream. Please try again.")
 
+async def async_create_threads(count):
+    return await asyncio.gather(*(openai_service.call(aclient.beta.threads.create) for _ in range(count)))
+
+def ensure_broadcast_threads(assistant_ids):
+    # OpenAI allows one active run per thread, so every broadcast assistant gets its own thread
+    missing = [assistant_id for assistant_id in assistant_ids if assistant_id not in st.session_state.broadcast_threads]
+    if missing:
+        threads = openai_service.run(async_create_threads(len(missing)))
+        for assistant_id, thread in zip(missing, threads):
+            st.session_state.broadcast_threads[assistant_id] = thread.id
+        # Runs inside the chat fragment, which does not reach the end-of-script save
+        save_session_state()
+    return {assistant_id: st.session_state.broadcast_threads[assistant_id] for assistant_id in assistant_ids}
+
+async def async_open_run_stream(thread_id, assistant_id, options):
+    # Returns (manager, event handler) once the run has started; the caller must __aexit__ the manager.
+    # A fresh manager per call, since call() may retry and a manager can only be entered once.
+    manager = aclient.beta.threads.runs.stream(
+        thread_id=thread_id, assistant_id=assistant_id,
+        timeout=httpx.Timeout(OPENAI_STREAM_TIMEOUT, connect=OPENAI_HTTP_CONNECT_TIMEOUT), **options)
+    return manager, await manager.__aenter__()
+
+async def async_stream_to_queue(key, thread_id, assistant_id, message_content, options, events):
+    # Pushes (key, 'delta', text) events, then one (key, 'done', timings) or (key, 'error', message)
+    started = time.monotonic()
+    timings = {'first_token': None, 'total': None, 'usage': None, 'run': None}
+
+    async def consume(stream):
+        async for text in stream.text_deltas:
+            if timings['first_token'] is None:
+                timings['first_token'] = time.monotonic() - started
+            events.put((key, 'delta', text))
+        await stream.until_done()
+        if stream.current_run:
+            timings['usage'] = stream.current_run.usage
+            timings['run'] = stream.current_run
+            if stream.current_run.usage:
+                openai_service.scheduler.charge_tokens(stream.current_run.usage.total_tokens)
+
+    try:
+        await openai_service.call(aclient.beta.threads.messages.create, thread_id=thread_id, role="user",
+                                  content=message_content)
+        # Starting the run is scheduled, retried and bounded by OPENAI_CALL_TIMEOUT; reading it only holds
+        # an open-stream slot
+        async with openai_service.streams:
+            manager, stream = await openai_service.call(async_open_run_stream, thread_id, assistant_id, options)
+            try:
+                await asyncio.wait_for(consume(stream), OPENAI_STREAM_TIMEOUT)
+            finally:
+                await manager.__aexit__(None, None, None)
+        timings['total'] = time.monotonic() - started
+        events.put((key, 'done', timings))
+    except Exception as e:
+        logging.error(f"Broadcast run for {key} failed: {str(e)}", exc_info=True)
+        events.put((key, 'error', str(e)))
+
+async def async_broadcast(runs, events):
+    await asyncio.gather(*(async_stream_to_queue(*run, events) for run in runs))
+
+def run_broadcast(user_message, assistant_names, chat_container):
+    try:
+        started = time.monotonic()
+        assistants = {name: st.session_state.assistants[name] for name in assistant_names}
+        # One concurrent existence check for every file, then one concurrent tool-resources push, so
+        # pre-run latency tracks the slowest assistant rather than the sum
+        check_files_exist_on_server(list({file_id for assistant in assistants.values()
+                                          for file_id in assistant['file_ids']}))
+        file_sets = {name: split_message_files(assistant) for name, assistant in assistants.items()}
+        updates = [(name, assistants[name]['id'], code_file_ids)
+                   for name, (_, code_file_ids) in file_sets.items() if code_file_ids]
+        results = openai_service.run(async_update_many_tool_resources(
+            [(assistant_id, code_file_ids) for _, assistant_id, code_file_ids in updates]))
+        failed = set()
+        for (name, _, _), result in zip(updates, results):
+            if isinstance(result, Exception):
+                logging.error(f"Error updating tool resources for {name}: {str(result)}")
+                failed.add(name)
+
+        prepared = []
+        for name, assistant in assistants.items():
+            if name in failed:
+                st.error(f"Failed to update {name} with new file resources.")
+                continue
+            message_content = message_content_with_images(user_message, file_sets[name][0])
+            prepared.append((name, assistant['id'], message_content, run_options(assistant)))
+        if not prepared:
+            return
+        threads = ensure_broadcast_threads([assistant_id for _, assistant_id, _, _ in prepared])
+
+        events = queue.Queue()
+        runs = [(name, threads[assistant_id], assistant_id, message_content, options)
+                for name, assistant_id, message_content, options in prepared]
+        future = openai_service.submit(async_broadcast(runs, events))
+
+        with chat_container.chat_message("assistant"):
+            placeholders = {}
+            for column, (name, _, _, _) in zip(st.columns(len(prepared)), prepared):
+                with column:
+                    st.markdown(f"**{name}**")
+                    placeholders[name] = (st.empty(), st.empty())
+            texts = {name: '' for name in placeholders}
+            unrendered = {name: 0 for name in placeholders}
+            last_render = {name: started for name in placeholders}
+            frames = {name: 0 for name in placeholders}
+            deltas = {name: 0 for name in placeholders}
+            sent_bytes = {name: 0 for name in placeholders}
+            first_tokens = {}
+            pending = set(placeholders)
+            while pending:
+                batch = []
+                try:
+                    batch.append(events.get(timeout=STREAM_FLUSH_MS / 1000))
+                except queue.Empty:
+                    if future.done() and events.empty():
+                        break
+                while not events.empty():
+                    batch.append(events.get_nowait())
+
+                finished = set()
+                for name, kind, payload in batch:
+                    status_placeholder = placeholders[name][1]
+                    if kind == 'delta':
+                        texts[name] += payload
+                        unrendered[name] += len(payload)
+                        deltas[name] += 1
+                    elif kind == 'done':
+                        finished.add(name)
+                        first_tokens[name] = payload['first_token']
+                        status_placeholder.caption(
+                            f"First token {payload['first_token'] or 0:.2f}s · total {payload['total']:.2f}s · "
+                            f"{format_usage(payload['usage'])}")
+                        logging.info(f"Broadcast to {name}: first token {payload['first_token']}s, "
+                                     f"total {payload['total']:.2f}s, usage {payload['usage']}")
+                        assistant_id = st.session_state.assistants[name]['id']
+                        get_run_metrics_writer().record(
+                            st.session_state.user_id, assistant_id, threads[assistant_id], payload['run'],
+                            first_token_seconds=payload['first_token'], total_seconds=payload['total'])
+                    else:
+                        finished.add(name)
+                        status_placeholder.error("An error occurred during the message stream.")
+
+                # Same thresholds as coalesce_deltas: redraw a column on its first text, then at most every
+                # STREAM_FLUSH_MS or STREAM_FLUSH_CHARS, and once more when it finishes
+                now = time.monotonic()
+                for name in placeholders:
+                    if not unrendered[name]:
+                        continue
+                    if (name in finished or not frames[name] or unrendered[name] >= STREAM_FLUSH_CHARS
+                            or (now - last_render[name]) * 1000 >= STREAM_FLUSH_MS):
+                        placeholders[name][0].markdown(texts[name])
+                        frames[name] += 1
+                        sent_bytes[name] += len(texts[name].encode('utf-8'))
+                        unrendered[name] = 0
+                        last_render[name] = now
+                pending -= finished
+            for name in placeholders:
+                get_stream_metrics().record(deltas[name], frames[name], sent_bytes[name], first_tokens.get(name))
+            future.result()
+        record_chat_turn(user_message, [(name, texts[name]) for name in placeholders if texts[name]])
+        logging.info(f"Broadcast to {len(prepared)} assistants completed in {time.monotonic() - started:.2f}s")
+    except Exception as e:
+        logging.error(f"Error during broadcast: {str(e)}", exc_info=True)
+        st.error("An error occurred during the broadcast. Please try again.")
+
 def check_file_exists(file_id):
     if file_id in st.session_state.deleted_file_ids:
         return False
     return True  # Assume the file exists if it's not in deleted_file_ids
 
 def remove_assistant_from_db(assistant_id):
+    # Returns the file ids queued for deletion because no other assistant uses them
     try:
-        conn = get_db_connection()
-        with conn.cursor() as c:
-            c.execute("DELETE FROM user_assistants WHERE assistant_id = %s", (assistant_id,))
-        conn.commit()
-        conn.close()
-        logging.info(f"Assistant ID {assistant_id} removed from database")
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute("""
+                    SELECT af.file_id, ua.user_id FROM assistant_files af
+                    JOIN user_assistants ua ON ua.assistant_id = af.assistant_id
+                    WHERE af.assistant_id = %s AND NOT EXISTS (
+                        SELECT 1 FROM assistant_files other
+                        WHERE other.file_id = af.file_id AND other.assistant_id <> af.assistant_id
+                    )
+                """, (assistant_id,))
+                orphaned = c.fetchall()
+                # Held like any other removed file, since the current thread may still reference it
+                c.executemany("""
+                    INSERT INTO file_deletion_queue (file_id, user_id, status) VALUES (%s, %s, 'held')
+                    ON DUPLICATE KEY UPDATE user_id = VALUES(user_id), status = 'held', attempts = 0, last_error = NULL
+                """, [(row['file_id'], row['user_id']) for row in orphaned])
+                c.execute("DELETE FROM assistant_files WHERE assistant_id = %s", (assistant_id,))
+                c.execute("DELETE FROM user_assistants WHERE assistant_id = %s", (assistant_id,))
+            conn.commit()
+        logging.info(f"Assistant ID {assistant_id} removed from database, {len(orphaned)} files queued for deletion")
+        return [row['file_id'] for row in orphaned]
     except Exception as e:
         logging.error(f"Error removing assistant ID {assistant_id} from database: {str(e)}")
+        return []
 
 def create_assistant(user_id, assistant_name, description, instructions):
     try:
         tools = [{"type": "code_interpreter"}]
-        response = client.beta.assistants.create(
+        tool_resources = {"code_interpreter": {"file_ids": []}}
+        response = run_openai(
+            aclient.beta.assistants.create,
             name=assistant_name,
             description=description,
             instructions=instructions,
@@ -567,19 +2248,22 @@ def create_assistant(user_id, assistant_name, description, instructions):
         )
         assistant_id = response.id
 
-        conn = get_db_connection()
-        with conn.cursor() as c:
-            c.execute(
-                "INSERT INTO user_assistants (user_id, assistant_id, name, description, instructions, file_ids) VALUES (%s, %s, %s, %s, %s, %s)",
-                (user_id, assistant_id, assistant_name, description, instructions, json.dumps([])))
-        conn.commit()
-        conn.close()
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    "INSERT INTO user_assistants (user_id, assistant_id, name, description, instructions, tools, tool_resources) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                    (user_id, assistant_id, assistant_name, description, instructions, json.dumps(tools),
+                     json.dumps(tool_resources)))
+            conn.commit()
+        tool_state_cache[assistant_id] = {'tools': tools, 'tool_resources': tool_resources, 'version': 0}
 
         st.session_state.assistants[assistant_name] = {
             'id': assistant_id,
             'description': description,
             'instructions': instructions,
-            'file_ids': []
+            'file_ids': [],
+            'run_settings': {setting: None for setting in RUN_SETTINGS},
+            'version': 0
         }
         st.session_state.selected_assistant = assistant_name
         return response
@@ -588,6 +2272,150 @@ def create_assistant(user_id, assistant_name, description, instructions):
         st.error("Failed to create the assistant. Please check the input values and try again.")
         return None
 
+UPLOAD_HASH_CHUNK_SIZE = 1024 * 1024
+
+VISION_PREPROCESS = os.environ.get('VISION_PREPROCESS', '1') == '1'
+VISION_MAX_EDGE = int(os.environ.get('VISION_MAX_EDGE', '2048'))
+VISION_JPEG_QUALITY = int(os.environ.get('VISION_JPEG_QUALITY', '85'))
+VISION_PREPROCESS_WORKERS = int(os.environ.get('VISION_PREPROCESS_WORKERS', '2'))
+VISION_PREPROCESS_TIMEOUT = float(os.environ.get('VISION_PREPROCESS_TIMEOUT', '30'))
+VISION_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+@st.cache_resource
+def get_image_preprocess_executor():
+    return ThreadPoolExecutor(max_workers=VISION_PREPROCESS_WORKERS, thread_name_prefix='image-preprocess')
+
+def preprocess_vision_image(original, file_name):
+    # Returns (data, file_name) to upload, or None when the original is already the best choice.
+    # Runs on a worker thread; Pillow releases the GIL while decoding, resizing and encoding.
+    original_size = len(original)
+    image = Image.open(io.BytesIO(original))
+    source_format = image.format
+    if getattr(image, 'n_frames', 1) > 1:
+        return None  # Flattening an animated GIF would drop frames
+    has_metadata = 'exif' in image.info or 'xmp' in image.info
+    changed = image.getexif().get(274, 1) != 1  # 274 is the orientation tag
+
+    if source_format == 'JPEG' and max(image.size) > VISION_MAX_EDGE:
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still covers VISION_MAX_EDGE
+        image.draft('RGB', (VISION_MAX_EDGE, VISION_MAX_EDGE))
+    image = ImageOps.exif_transpose(image)
+    if max(image.size) > VISION_MAX_EDGE:
+        # reducing_gap does a fast integer reduce() before the final Lanczos resample
+        image.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        changed = True
+
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if has_alpha:
+        image = image.convert('RGBA')
+        candidates = [('PNG', {'optimize': True}), ('WEBP', {'quality': VISION_JPEG_QUALITY, 'method': 4})]
+    else:
+        image = image.convert('RGB')
+        candidates = [('JPEG', {'quality': VISION_JPEG_QUALITY, 'optimize': True, 'progressive': True})]
+        if source_format != 'JPEG':
+            # Screenshots and diagrams are often smaller as lossless PNG
+            candidates.append(('PNG', {'optimize': True}))
+
+    best = None
+    for image_format, options in candidates:
+        # Saving without exif/pnginfo drops EXIF, GPS and text metadata
+        output = io.BytesIO()
+        image.save(output, format=image_format, **options)
+        if best is None or output.tell() < best[1].tell():
+            best = (image_format, output)
+
+    image_format, output = best
+    if not changed and not has_metadata and output.tell() >= original_size:
+        return None
+    base_name = file_name.rsplit('.', 1)[0]
+    return output.getvalue(), f"{base_name}.{VISION_EXTENSIONS[image_format]}"
+
+def prepare_vision_upload(file, file_name):
+    # Returns the file argument for files.create: the processed (name, bytes) or the original upload
+    if not VISION_PREPROCESS:
+        file.seek(0)
+        return file
+    started = time.monotonic()
+    try:
+        # The worker reads its own stream over the upload's bytes (getvalue shares the buffer rather than
+        # copying), so a timed-out worker can't move the position of the file being uploaded
+        result = get_image_preprocess_executor().submit(preprocess_vision_image, file.getvalue(), file_name).result(
+            timeout=VISION_PREPROCESS_TIMEOUT)
+    except Exception as e:
+        logging.warning(f"Image preprocessing failed for {file_name}, uploading original: {str(e)}")
+        result = None
+    elapsed_ms = (time.monotonic() - started) * 1000
+    original_size = len(file.getbuffer())
+    file.seek(0)
+    if result is None:
+        logging.info(f"Image {file_name} uploaded as is ({original_size} bytes, checked in {elapsed_ms:.0f}ms)")
+        return file
+    data, new_name = result
+    saved = original_size - len(data)
+    logging.info(f"Image {file_name} preprocessed to {new_name}: {original_size} -> {len(data)} bytes "
+                 f"({saved} saved) in {elapsed_ms:.0f}ms")
+    st.toast(f"Optimized {file_name}: {original_size / 1024:.0f} KB -> {len(data) / 1024:.0f} KB "
+             f"in {elapsed_ms:.0f} ms")
+    return (new_name, data)
+
+def hash_uploaded_file(file):
+    # Streams the upload through SHA-256 a chunk at a time and rewinds it for the upload
+    digest = hashlib.sha256()
+    size = 0
+    file.seek(0)
+    for chunk in iter(lambda: file.read(UPLOAD_HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return digest.hexdigest(), size
+
+def find_file_blob(user_id, sha256, purpose):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT file_id, filename FROM file_blobs WHERE user_id = %s AND sha256 = %s AND purpose = %s",
+                      (user_id, sha256, purpose))
+            return c.fetchone()
+
+def save_file_blob(user_id, sha256, purpose, file_id, filename, size):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                INSERT INTO file_blobs (user_id, sha256, purpose, file_id, filename, size)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE file_id = VALUES(file_id), filename = VALUES(filename), size = VALUES(size)
+            """, (user_id, sha256, purpose, file_id, filename, size))
+        conn.commit()
+
+def forget_file_blob(user_id, sha256, purpose):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("DELETE FROM file_blobs WHERE user_id = %s AND sha256 = %s AND purpose = %s",
+                      (user_id, sha256, purpose))
+        conn.commit()
+
+def cancel_file_deletion(file_id):
+    # Returns False when the worker has already claimed or deleted the file
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT status FROM file_deletion_queue WHERE file_id = %s FOR UPDATE", (file_id,))
+            row = c.fetchone()
+            if row and row['status'] in ('in_progress', 'done'):
+                conn.commit()
+                return False
+            c.execute("DELETE FROM file_deletion_queue WHERE file_id = %s", (file_id,))
+        conn.commit()
+    return True
+
+def reuse_uploaded_file(user_id, sha256, purpose):
+    # Returns the blob row of a previous upload with the same content that is still usable, or None
+    blob = find_file_blob(user_id, sha256, purpose)
+    if not blob:
+        return None
+    if check_file_exists_on_server(blob['file_id']) and cancel_file_deletion(blob['file_id']):
+        return blob
+    forget_file_blob(user_id, sha256, purpose)
+    return None
+
 def get_or_upload_file(file):
     try:
         file_name = file.name
@@ -598,131 +2426,678 @@ def get_or_upload_file(file):
         else:
             purpose = 'assistants'
 
-        # Upload the file
-        file_response = client.files.create(file=file, purpose=purpose)
+        user_id = st.session_state.user_id
+        sha256, size = hash_uploaded_file(file)
+        blob = reuse_uploaded_file(user_id, sha256, purpose)
+        if blob:
+            file_id = blob['file_id']
+            file_name = blob['filename'] or file_name
+            logging.info(f"Reusing file {file_id} for upload of {file.name} ({size} bytes, sha256 {sha256})")
+        else:
+            # UploadedFile is passed through as a file object, so httpx streams it without another full copy
+            upload = prepare_vision_upload(file, file_name) if purpose == 'vision' else file
+            file_response = run_openai(aclient.files.create, file=upload, purpose=purpose)
+            file_id = file_response.id
+            save_file_blob(user_id, sha256, purpose, file_id, file_name, size)
+            get_file_metadata_cache().set(file_id, {'id': file_id, 'filename': file_name, 'purpose': purpose})
         file_info = {
-            'id': file_response.id,
+            'id': file_id,
             'name': file_name,
             'purpose': purpose
         }
         # Remove from deleted_file_ids if it was there
-        if file_response.id in st.session_state.deleted_file_ids:
-            st.session_state.deleted_file_ids.remove(file_response.id)
+        st.session_state.deleted_file_ids.discard(file_id)
         # Update session state
         if purpose not in st.session_state.file_info:
             st.session_state.file_info[purpose] = {}
-        st.session_state.file_info[purpose][file_response.id] = file_name
+        st.session_state.file_info[purpose][file_id] = file_name
 
         return file_info
     except Exception as e:
         logging.error(f"Error uploading file: {str(e)}")
         return None
 
-def update_assistant_file_ids(user_id, assistant_id, file_ids):
-    conn = get_db_connection()
-    with conn.cursor() as c:
-        c.execute("UPDATE user_assistants SET file_ids = %s WHERE user_id = %s AND assistant_id = %s",
-                  (json.dumps(file_ids), user_id, assistant_id))
-    conn.commit()
-    conn.close()
+def bump_assistant_versions(c, assistant_ids):
+    # Inside the transaction that changes the assistants; see migrate_assistant_state_version
+    c.executemany("UPDATE user_assistants SET state_version = state_version + 1 WHERE assistant_id = %s",
+                  [(assistant_id,) for assistant_id in assistant_ids])
 
-def check_file_exists_on_server(file_id):
+def attach_file_to_assistant(assistant_id, file_id, purpose, shared=False):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                INSERT INTO assistant_files (assistant_id, file_id, purpose, shared) VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE purpose = VALUES(purpose), shared = VALUES(shared)
+            """, (assistant_id, file_id, purpose, shared))
+            bump_assistant_versions(c, [assistant_id])
+        conn.commit()
+
+def detach_file_from_assistant(assistant_id, file_id):
+    # Returns whether the detached file had been shared, or None if it was not attached
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT shared FROM assistant_files WHERE assistant_id = %s AND file_id = %s FOR UPDATE",
+                      (assistant_id, file_id))
+            row = c.fetchone()
+            if row:
+                c.execute("DELETE FROM assistant_files WHERE assistant_id = %s AND file_id = %s",
+                          (assistant_id, file_id))
+                bump_assistant_versions(c, [assistant_id])
+        conn.commit()
+    return bool(row['shared']) if row else None
+
+BULK_UPDATE_CONCURRENCY = int(os.environ.get('BULK_UPDATE_CONCURRENCY', '8'))
+async def async_push_limited(assistant_id, file_ids, limiter):
+    # Each OpenAI request is already retried by openai_service.call
+    async with limiter:
+        return await async_push_tool_resources(assistant_id, file_ids)
+
+async def async_push_file_sets(updates):
+    # updates: [(assistant_id, file_ids)]; exceptions are returned in place so one failure doesn't sink the rest
+    limiter = asyncio.Semaphore(BULK_UPDATE_CONCURRENCY)
+    return await asyncio.gather(*(async_push_limited(assistant_id, file_ids, limiter)
+                                  for assistant_id, file_ids in updates), return_exceptions=True)
+
+def bulk_update_assistant_files(assistants, file_id, purpose=None, attach=True, shared=True):
+    # Attach file_id to (or detach it from) many assistants concurrently, then record every change in one
+    # transaction. Returns (succeeded, failed) lists of assistant dicts.
+    targets = [assistant for assistant in assistants if (file_id in assistant['file_ids']) != attach]
+    if not targets:
+        return [], []
+    updates = []
+    for assistant in targets:
+        if attach:
+            updates.append((assistant['id'], assistant['file_ids'] + [file_id]))
+        else:
+            updates.append((assistant['id'], [fid for fid in assistant['file_ids'] if fid != file_id]))
+    results = openai_service.run(async_push_file_sets(updates))
+
+    succeeded, failed, tool_states = [], [], []
+    for assistant, (assistant_id, new_file_ids), result in zip(targets, updates, results):
+        if isinstance(result, Exception):
+            logging.error(f"Error updating tool resources for assistant {assistant_id}: {str(result)}")
+            failed.append(assistant)
+            continue
+        succeeded.append((assistant, new_file_ids))
+        state, changed = result
+        if changed:
+            tool_states.append((assistant_id, state))
+
+    if succeeded:
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                if attach:
+                    c.executemany("""
+                        INSERT INTO assistant_files (assistant_id, file_id, purpose, shared) VALUES (%s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE purpose = VALUES(purpose), shared = VALUES(shared)
+                    """, [(assistant['id'], file_id, purpose, shared) for assistant, _ in succeeded])
+                else:
+                    c.executemany("DELETE FROM assistant_files WHERE assistant_id = %s AND file_id = %s",
+                                  [(assistant['id'], file_id) for assistant, _ in succeeded])
+                if tool_states:
+                    c.executemany("UPDATE user_assistants SET tools = %s, tool_resources = %s WHERE assistant_id = %s",
+                                  [(json.dumps(state['tools']), json.dumps(state['tool_resources']), assistant_id)
+                                   for assistant_id, state in tool_states])
+                bump_assistant_versions(c, [assistant['id'] for assistant, _ in succeeded])
+            conn.commit()
+        # Re-read with the new versions on next use
+        for assistant, _ in succeeded:
+            tool_state_cache.pop(assistant['id'], None)
+        for assistant, new_file_ids in succeeded:
+            assistant['file_ids'] = new_file_ids
+    logging.info(f"{'Attached' if attach else 'Detached'} file {file_id}: {len(succeeded)} succeeded, "
+                 f"{len(failed)} failed")
+    return [assistant for assistant, _ in succeeded], failed
+
+def get_assistants_using_file(user_id, file_id):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT af.assistant_id
+                FROM assistant_files af
+                JOIN user_assistants ua ON ua.assistant_id = af.assistant_id
+                WHERE af.file_id = %s AND ua.user_id = %s
+            """, (file_id, user_id))
+            return [row['assistant_id'] for row in c.fetchall()]
+
+FILE_CACHE_TTL = float(os.environ.get('FILE_CACHE_TTL', '300'))
+FILE_CACHE_NEGATIVE_TTL = float(os.environ.get('FILE_CACHE_NEGATIVE_TTL', '60'))
+FILE_CHECK_WORKERS = int(os.environ.get('FILE_CHECK_WORKERS', '8'))
+
+class FileMetadataCache:
+    # file_id -> metadata dict, or None for files known not to exist
+    def __init__(self, ttl, negative_ttl):
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, file_id):
+        # Returns (found, metadata)
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry and entry[1] > time.monotonic():
+                self._hits += 1
+                return True, entry[0]
+            if entry:
+                del self._entries[file_id]
+            self._misses += 1
+            return False, None
+
+    def set(self, file_id, metadata):
+        ttl = self._ttl if metadata is not None else self._negative_ttl
+        with self._lock:
+            self._entries[file_id] = (metadata, time.monotonic() + ttl)
+
+    def invalidate(self, file_id):
+        with self._lock:
+            self._entries.pop(file_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+            }
+
+@st.cache_resource
+def get_file_metadata_cache():
+    return FileMetadataCache(FILE_CACHE_TTL, FILE_CACHE_NEGATIVE_TTL)
+
+@st.cache_resource
+def get_file_check_executor():
+    return ThreadPoolExecutor(max_workers=FILE_CHECK_WORKERS, thread_name_prefix='file-check')
+
+def fetch_file_metadata(file_id):
+    # Runs on worker threads: returns (cacheable, metadata) and leaves caching to the caller
     try:
-        api_url = f"https://api.openai.com/v1/files/{file_id}"
-        headers = {"Authorization": f"Bearer {openai.api_key}"}
-        response = requests.get(api_url, headers=headers)
-        return response.status_code == 200
+        response = openai_api_get(f"files/{file_id}")
+        if response.status_code == 200:
+            return True, response.json()
+        if response.status_code == 404:
+            return True, None
+        logging.error(f"Unexpected status {response.status_code} checking file {file_id}")
+        return False, None
     except Exception as e:
         logging.error(f"Error checking file existence on server: {str(e)}")
-        return False
+        return False, None
+
+def check_files_exist_on_server(file_ids):
+    cache = get_file_metadata_cache()
+    results = {}
+    missing = []
+    for file_id in file_ids:
+        found, metadata = cache.get(file_id)
+        if found:
+            results[file_id] = metadata is not None
+        else:
+            missing.append(file_id)
+
+    # Cold lookups run concurrently
+    if missing:
+        executor = get_file_check_executor()
+        futures = [submit_as_user(executor, fetch_file_metadata, file_id) for file_id in missing]
+        for file_id, (cacheable, metadata) in zip(missing, (future.result() for future in futures)):
+            if cacheable:
+                cache.set(file_id, metadata)
+            results[file_id] = metadata is not None
+    logging.info(f"File metadata cache: {len(file_ids) - len(missing)} hits, {len(missing)} misses, "
+                 f"process hit rate {cache.stats()['hit_rate']:.1%}")
+    return results
+
+def check_file_exists_on_server(file_id):
+    return check_files_exist_on_server([file_id])[file_id]
+
+@st.cache_resource
+def get_tool_state_cache():
+    # assistant_id -> {'tools': [...], 'tool_resources': {...}, 'version': state_version} as last applied on OpenAI
+    return {}
+
+if not IN_WORKER_PROCESS:
+    tool_state_cache = get_tool_state_cache()
+
+def get_assistant_tool_state(assistant_id):
+    cached_state = tool_state_cache.get(assistant_id)
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            if cached_state is not None:
+                # Another instance may have updated the assistant since this one cached it
+                c.execute("SELECT state_version FROM user_assistants WHERE assistant_id = %s", (assistant_id,))
+                row = c.fetchone()
+                if row and row['state_version'] == cached_state['version']:
+                    return cached_state
+            c.execute("SELECT tools, tool_resources, state_version FROM user_assistants WHERE assistant_id = %s",
+                      (assistant_id,))
+            row = c.fetchone()
+    if not row or row['tools'] is None or row['tool_resources'] is None:
+        tool_state_cache.pop(assistant_id, None)
+        return None
+    tool_state_cache[assistant_id] = {'tools': json.loads(row['tools']),
+                                      'tool_resources': json.loads(row['tool_resources']),
+                                      'version': row['state_version']}
+    return tool_state_cache[assistant_id]
+
+def save_assistant_tool_state(assistant_id, tools, tool_resources):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                UPDATE user_assistants SET tools = %s, tool_resources = %s, state_version = state_version + 1
+                WHERE assistant_id = %s
+            """, (json.dumps(tools), json.dumps(tool_resources), assistant_id))
+            c.execute("SELECT state_version FROM user_assistants WHERE assistant_id = %s", (assistant_id,))
+            row = c.fetchone()
+        conn.commit()
+    if row:
+        tool_state_cache[assistant_id] = {'tools': tools, 'tool_resources': tool_resources,
+                                          'version': row['state_version']}
+
+async def async_push_tool_resources(assistant_id, file_ids):
+    # Returns (state, changed): the tool state now live on OpenAI, not yet persisted when changed, or the
+    # cached state it matched. Returning the cached copy spares callers a second tool_state_cache lookup,
+    # which another thread may have invalidated in between.
+    tool_resources = {
+        "code_interpreter": {
+            "file_ids": sorted(set(file_ids))
+        }
+    }
+    cached_state = await asyncio.to_thread(get_assistant_tool_state, assistant_id)
+    if cached_state and cached_state['tool_resources'] == tool_resources:
+        logging.info(f"Tool resources for assistant {assistant_id} unchanged, skipping update")
+        return cached_state, False
+
+    # Only retrieve the assistant when we have never seen its tools
+    if cached_state:
+        tools = cached_state['tools']
+    else:
+        current_assistant = await openai_service.call(aclient.beta.assistants.retrieve, assistant_id)
+        tools = [tool.model_dump(exclude_none=True) for tool in current_assistant.tools]
+    updated_assistant = await openai_service.call(
+        aclient.beta.assistants.update,
+        assistant_id=assistant_id,
+        tools=tools,
+        tool_resources=tool_resources
+    )
+    logging.info(f"Updated assistant: {updated_assistant}")
+    return {'tools': [tool.model_dump(exclude_none=True) for tool in updated_assistant.tools],
+            'tool_resources': tool_resources}, True
+
+async def async_update_assistant_tool_resources(assistant_id, file_ids):
+    # Raises on failure; update_assistant_tool_resources is the logging sync wrapper
+    state, changed = await async_push_tool_resources(assistant_id, file_ids)
+    if not changed:
+        return state
+    await asyncio.to_thread(save_assistant_tool_state, assistant_id, state['tools'], state['tool_resources'])
+    return state
+
+async def async_update_many_tool_resources(updates):
+    # updates: [(assistant_id, file_ids)]; exceptions are returned in place
+    return await asyncio.gather(*(async_update_assistant_tool_resources(assistant_id, file_ids)
+                                  for assistant_id, file_ids in updates), return_exceptions=True)
 
 def update_assistant_tool_resources(assistant_id, file_ids):
     try:
-        current_assistant = client.beta.assistants.retrieve(assistant_id)
-        unique_file_ids = list(set(file_ids))
-        updated_assistant = client.beta.assistants.update(
-            assistant_id=assistant_id,
-            tools=current_assistant.tools,
-            tool_resources={
-                "code_interpreter": {
-                    "file_ids": unique_file_ids
-                }
-            }
-        )
-        logging.info(f"Updated assistant: {updated_assistant}")
-        return updated_assistant
+        return openai_service.run(async_update_assistant_tool_resources(assistant_id, file_ids))
     except Exception as e:
         logging.error(f"Error updating assistant tool resources: {str(e)}")
         return None
 
 def delete_assistant(assistant_id):
     try:
-        response = client.beta.assistants.delete(assistant_id=assistant_id)
+        response = run_openai(aclient.beta.assistants.delete, assistant_id=assistant_id)
+        tool_state_cache.pop(assistant_id, None)
         logging.debug("Assistant deleted successfully")
         return response
     except Exception as e:
         logging.error(f"Error deleting assistant: {str(e)}")
         return None
 
-def delete_file_from_openai(file_id):
-    try:
-        response = client.files.delete(file_id)
-        logging.info(f"File {file_id} deleted from OpenAI. Response: {response}")
+GC_BATCH_SIZE = int(os.environ.get('GC_BATCH_SIZE', '20'))
+GC_CONCURRENCY = int(os.environ.get('GC_CONCURRENCY', '4'))
+GC_INTERVAL = float(os.environ.get('GC_INTERVAL', '10'))
+GC_MAX_ATTEMPTS = int(os.environ.get('GC_MAX_ATTEMPTS', '5'))
+GC_BACKOFF = int(os.environ.get('GC_BACKOFF', '30'))
+GC_CLAIM_TIMEOUT = int(os.environ.get('GC_CLAIM_TIMEOUT', '300'))
+GC_DONE_RETENTION_DAYS = int(os.environ.get('GC_DONE_RETENTION_DAYS', '7'))
+GC_PRUNE_INTERVAL = float(os.environ.get('GC_PRUNE_INTERVAL', '3600'))
+
+def enqueue_file_deletion(user_id, file_id):
+    # Held until the user starts a new thread, since the current thread may still reference the file
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                INSERT INTO file_deletion_queue (file_id, user_id, status) VALUES (%s, %s, 'held')
+                ON DUPLICATE KEY UPDATE user_id = VALUES(user_id), status = 'held', attempts = 0, last_error = NULL
+            """, (file_id, user_id))
+        conn.commit()
+
+def release_file_deletions(user_id):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            released = c.execute("""
+                UPDATE file_deletion_queue SET status = 'pending', next_attempt_at = NOW()
+                WHERE user_id = %s AND status = 'held'
+            """, (user_id,))
+        conn.commit()
+    logging.info(f"Released {released} queued file deletions for user {user_id}")
+    return released
+
+def load_queued_file_deletions(user_id):
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT file_id FROM file_deletion_queue
+                WHERE user_id = %s AND status IN ('held', 'pending', 'in_progress')
+            """, (user_id,))
+            return {row['file_id'] for row in c.fetchall()}
+
+class FileDeletionWorker:
+    # Background thread that drains file_deletion_queue; safe to run on several instances at once
+    def __init__(self, file_metadata_cache, image_cache):
+        self._file_metadata_cache = file_metadata_cache
+        self._image_cache = image_cache
+        self._thread = threading.Thread(target=self._run, name='file-gc', daemon=True)
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._metrics = {'batches': 0, 'deleted': 0, 'failed_attempts': 0, 'gave_up': 0, 'last_batch_seconds': 0.0}
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        last_prune = 0.0
+        while True:
+            try:
+                claimed = self.run_batch()
+                if time.monotonic() - last_prune >= GC_PRUNE_INTERVAL:
+                    self.prune_done()
+                    last_prune = time.monotonic()
+            except Exception as e:
+                logging.error(f"File deletion worker error: {str(e)}", exc_info=True)
+                claimed = 0
+            if claimed < GC_BATCH_SIZE:
+                time.sleep(GC_INTERVAL)
+
+    def prune_done(self):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                pruned = c.execute("""
+                    DELETE FROM file_deletion_queue
+                    WHERE status = 'done' AND deleted_at < NOW() - INTERVAL %s DAY
+                """, (GC_DONE_RETENTION_DAYS,))
+            conn.commit()
+        if pruned:
+            logging.info(f"Pruned {pruned} completed file deletions older than {GC_DONE_RETENTION_DAYS} days")
+        return pruned
+
+    def _claim_batch(self):
+        claim_token = uuid.uuid4().hex
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                # Stale in_progress rows belong to an instance that died mid-batch
+                c.execute("""
+                    UPDATE file_deletion_queue SET status = 'in_progress', claimed_by = %s, claimed_at = NOW()
+                    WHERE (status = 'pending' AND next_attempt_at <= NOW())
+                       OR (status = 'in_progress' AND claimed_at < NOW() - INTERVAL %s SECOND)
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                """, (claim_token, GC_CLAIM_TIMEOUT, GC_BATCH_SIZE))
+                c.execute("SELECT file_id, attempts FROM file_deletion_queue WHERE claimed_by = %s", (claim_token,))
+                rows = c.fetchall()
+            conn.commit()
+        return rows
+
+    async def _delete_files(self, file_ids):
+        limiter = asyncio.Semaphore(GC_CONCURRENCY)
+
+        async def delete(file_id):
+            async with limiter:
+                try:
+                    await openai_service.call(aclient.files.delete, file_id)
+                except openai.NotFoundError:
+                    pass  # Already gone counts as deleted
+
+        return await asyncio.gather(*(delete(file_id) for file_id in file_ids), return_exceptions=True)
+
+    def run_batch(self):
+        rows = self._claim_batch()
+        if not rows:
+            return 0
+        started = time.monotonic()
+        results = openai_service.run(self._delete_files([row['file_id'] for row in rows]))
+
+        done, retry, gave_up = [], [], []
+        for row, result in zip(rows, results):
+            if not isinstance(result, Exception):
+                done.append((row['file_id'],))
+                self._file_metadata_cache.set(row['file_id'], None)
+                self._image_cache.invalidate(row['file_id'])
+                continue
+            logging.warning(f"Deleting file {row['file_id']} failed: {str(result)}")
+            attempts = row['attempts'] + 1
+            status = 'failed' if attempts >= GC_MAX_ATTEMPTS else 'pending'
+            delay = GC_BACKOFF * 2 ** (attempts - 1)
+            retry.append((status, attempts, delay, str(result)[:1000], row['file_id']))
+            if status == 'failed':
+                gave_up.append(row['file_id'])
+
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                if done:
+                    c.executemany("""
+                        UPDATE file_deletion_queue SET status = 'done', deleted_at = NOW(), claimed_by = NULL
+                        WHERE file_id = %s
+                    """, done)
+                    # Deleted files can no longer satisfy a content-hash match
+                    c.executemany("DELETE FROM file_blobs WHERE file_id = %s", done)
+                if retry:
+                    c.executemany("""
+                        UPDATE file_deletion_queue
+                        SET status = %s, attempts = %s, next_attempt_at = NOW() + INTERVAL %s SECOND,
+                            last_error = %s, claimed_by = NULL
+                        WHERE file_id = %s
+                    """, retry)
+            conn.commit()
+
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._metrics['batches'] += 1
+            self._metrics['deleted'] += len(done)
+            self._metrics['failed_attempts'] += len(retry)
+            self._metrics['gave_up'] += len(gave_up)
+            self._metrics['last_batch_seconds'] = elapsed
+        logging.info(f"File deletion batch: {len(done)} deleted, {len(retry)} failed in {elapsed:.2f}s")
+        if gave_up:
+            logging.error(f"Giving up deleting files after {GC_MAX_ATTEMPTS} attempts: {gave_up}")
+        return len(rows)
+
+    def stats(self):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT status, COUNT(*) AS count FROM file_deletion_queue GROUP BY status")
+                counts = {row['status']: row['count'] for row in c.fetchall()}
+        with self._lock:
+            stats = dict(self._metrics)
+        uptime = time.monotonic() - self._started_at
+        stats['deleted_per_minute'] = stats['deleted'] * 60 / uptime if uptime else 0.0
+        stats['backlog'] = counts.get('pending', 0) + counts.get('in_progress', 0)
+        stats['held'] = counts.get('held', 0)
+        stats['failed'] = counts.get('failed', 0)
+        return stats
+
+@st.cache_resource
+def get_file_gc_worker():
+    worker = FileDeletionWorker(get_file_metadata_cache(), get_image_cache())
+    worker.start()
+    return worker
 
-        return True
-    except Exception as e:
-        logging.error(f"Error deleting file {file_id} from OpenAI: {str(e)}")
-        return False
 def is_user_logged_in():
     return st.session_state.user_id is not None
 
+PASSWORD_TIME_COST = int(os.environ.get('PASSWORD_TIME_COST', str(argon2.DEFAULT_TIME_COST)))
+PASSWORD_MEMORY_COST = int(os.environ.get('PASSWORD_MEMORY_COST', str(argon2.DEFAULT_MEMORY_COST)))  # KiB
+PASSWORD_PARALLELISM = int(os.environ.get('PASSWORD_PARALLELISM', str(argon2.DEFAULT_PARALLELISM)))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(max(1, (os.cpu_count() or 2) // 2))))
+PASSWORD_MAX_PENDING = int(os.environ.get('PASSWORD_MAX_PENDING', str(PASSWORD_HASH_WORKERS * 4)))
+PASSWORD_QUEUE_TIMEOUT = float(os.environ.get('PASSWORD_QUEUE_TIMEOUT', '5'))
+
+# Shared by every session; only used in-process for the cheap check_needs_rehash parameter comparison
+password_hasher = argon2.PasswordHasher(time_cost=PASSWORD_TIME_COST, memory_cost=PASSWORD_MEMORY_COST,
+                                        parallelism=PASSWORD_PARALLELISM)
+
+class PasswordHashBusy(Exception):
+    pass
+
+class PasswordHashPool:
+    # Runs Argon2 in worker processes so a burst of logins can't starve the script threads of CPU.
+    # Workers are spawned and only run argon2.low_level functions, which pickle by reference without
+    # importing this script.
+    def __init__(self):
+        self._executor = self._new_executor()
+        self._slots = threading.BoundedSemaphore(PASSWORD_MAX_PENDING)
+        self._lock = threading.Lock()
+        self._metrics = {'hashes': 0, 'verifies': 0, 'rejected': 0, 'restarts': 0, 'seconds_total': 0.0}
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+    def _replace_broken(self, executor):
+        # A broken ProcessPoolExecutor never recovers; the first caller to notice swaps in a new one
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = self._new_executor()
+            self._metrics['restarts'] += 1
+        logging.error("Password hash worker died, restarted the process pool")
+        executor.shutdown(wait=False)
+
+    def _call(self, kind, fn, *args):
+        if not self._slots.acquire(timeout=PASSWORD_QUEUE_TIMEOUT):
+            with self._lock:
+                self._metrics['rejected'] += 1
+            logging.warning(f"Password hash queue full ({PASSWORD_MAX_PENDING} pending), rejecting {kind}")
+            raise PasswordHashBusy()
+        started = time.monotonic()
+        executor = self._executor
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            # A worker died, e.g. OOM-killed after PASSWORD_MEMORY_COST was raised; the user can retry
+            self._replace_broken(executor)
+            raise PasswordHashBusy()
+        finally:
+            self._slots.release()
+            with self._lock:
+                self._metrics[kind] += 1
+                self._metrics['seconds_total'] += time.monotonic() - started
+
+    def hash(self, password):
+        salt = os.urandom(password_hasher.salt_len)
+        hashed = self._call('hashes', argon2.low_level.hash_secret, password.encode('utf-8'), salt,
+                            password_hasher.time_cost, password_hasher.memory_cost, password_hasher.parallelism,
+                            password_hasher.hash_len, password_hasher.type)
+        return hashed.decode('ascii')
+
+    def verify(self, password, hashed_password):
+        hash_type = argon2.extract_parameters(hashed_password).type
+        return self._call('verifies', argon2.low_level.verify_secret, hashed_password.encode('ascii'),
+                          password.encode('utf-8'), hash_type)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+        calls = stats['hashes'] + stats['verifies']
+        stats['seconds_avg'] = stats['seconds_total'] / calls if calls else 0.0
+        return stats
+
+@st.cache_resource
+def get_password_hash_pool():
+    return PasswordHashPool()
+
 def hash_password(password):
-    hasher = argon2.PasswordHasher()
-    return hasher.hash(password.encode('utf-8'))
+    return get_password_hash_pool().hash(password)
 
 def verify_password(password, hashed_password):
-    hasher = argon2.PasswordHasher()
     try:
-        hasher.verify(hashed_password, password.encode('utf-8'))
-        return True
-    except argon2.exceptions.VerifyMismatchError:
+        return get_password_hash_pool().verify(password, hashed_password)
+    except (argon2.exceptions.VerifyMismatchError, argon2.exceptions.InvalidHashError):
         return False
 
+def rehash_password_if_needed(user_id, password, hashed_password):
+    # Upgrade hashes made with older cost settings while the plaintext is available
+    if not password_hasher.check_needs_rehash(hashed_password):
+        return
+    try:
+        new_hash = hash_password(password)
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute("UPDATE users SET password = %s WHERE id = %s", (new_hash, user_id))
+            conn.commit()
+        logging.info(f"Upgraded password hash parameters for user {user_id}")
+    except Exception as e:
+        logging.error(f"Error rehashing password for user {user_id}: {str(e)}")
+
 def create_user(username, password):
     hashed_password = hash_password(password)
-    conn = get_db_connection()
-    with conn.cursor() as c:
-        c.execute("INSERT INTO users (username, password) VALUES (%s, %s)",
-                  (username, hashed_password))
-        user_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("INSERT INTO users (username, password) VALUES (%s, %s)",
+                      (username, hashed_password))
+            user_id = c.lastrowid
+        conn.commit()
     return user_id
 
 def verify_user(username, password):
-    conn = get_db_connection()
-    with conn.cursor() as c:
-        c.execute("""
-            SELECT u.id, u.password, u.thread_id, ua.assistant_id
-            FROM users u
-            LEFT JOIN user_assistants ua ON u.id = ua.user_id
-            WHERE u.username = %s
-        """, (username,))
-        user = c.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT u.id, u.password, u.thread_id, ua.assistant_id
+                FROM users u
+                LEFT JOIN user_assistants ua ON u.id = ua.user_id
+                WHERE u.username = %s
+            """, (username,))
+            user = c.fetchone()
     if user:
         stored_password = user['password']
         if verify_password(password, stored_password):
+            rehash_password_if_needed(user['id'], password, stored_password)
             return user['id'], user['thread_id'] or None, user.get('assistant_id')  # user_id, thread_id, assistant_id
     return None, None, None
 
 def delete_user_account(username):
-    conn = get_db_connection()
-    with conn.cursor() as c:
-        c.execute("DELETE FROM users WHERE username = %s", (username,))
-        c.execute("DELETE FROM user_assistants WHERE user_id = (SELECT id FROM users WHERE username = %s)", (username,))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            # Files the account still used go straight to the GC worker, as do removed files still held
+            # for a thread nobody will start again
+            c.execute("""
+                INSERT INTO file_deletion_queue (file_id, user_id, status, next_attempt_at)
+                SELECT DISTINCT af.file_id, u.id, 'pending', NOW() FROM assistant_files af
+                JOIN user_assistants ua ON ua.assistant_id = af.assistant_id
+                JOIN users u ON u.id = ua.user_id
+                WHERE u.username = %s
+                ON DUPLICATE KEY UPDATE status = IF(status IN ('held', 'failed'), 'pending', status),
+                                        next_attempt_at = NOW()
+            """, (username,))
+            c.execute("""
+                DELETE af FROM assistant_files af
+                JOIN user_assistants ua ON ua.assistant_id = af.assistant_id
+                JOIN users u ON u.id = ua.user_id
+                WHERE u.username = %s
+            """, (username,))
+            c.execute("""
+                UPDATE file_deletion_queue SET status = 'pending', next_attempt_at = NOW()
+                WHERE status = 'held' AND user_id = (SELECT id FROM users WHERE username = %s)
+            """, (username,))
+            c.execute("DELETE FROM chat_messages WHERE user_id = (SELECT id FROM users WHERE username = %s)", (username,))
+            c.execute("DELETE FROM run_metrics WHERE user_id = (SELECT id FROM users WHERE username = %s)", (username,))
+            c.execute("DELETE FROM file_blobs WHERE user_id = (SELECT id FROM users WHERE username = %s)", (username,))
+            c.execute("DELETE FROM user_assistants WHERE user_id = (SELECT id FROM users WHERE username = %s)", (username,))
+            c.execute("DELETE FROM users WHERE username = %s", (username,))
+        conn.commit()
     logging.info(f"User account for {username} has been deleted.")
 
 def show_how_to():
@@ -734,7 +3109,7 @@ def show_how_to():
     The description can be simple. The instructions are more important and extensive instructions can be pasted into the instruction block.
     starter examples below. After file upload always click the "x" next to the file before you start the dialog with the assistant. Up to 20 files can be uploaded.
     Each thread is a "memory" so the assistant will remember your conversation until you create a new thread, even if you logout. Uploaded files are deleted when you create a new thread, but you must remove all files from all assistants first. unclick the view images if you do not want to keep seeing the image after the chat.
-    The share files click is problematic for more than three assistants, so it is best to leave it unclicked. A very useful tip is that you can upload PNG files that are screen saves or snips for the assistant
+    With "Share files among assistants" checked, an upload is attached to every assistant at once, and removing a shared file removes it from all of them. A very useful tip is that you can upload PNG files that are screen saves or snips for the assistant
     to interpret and use; this is a very powerful and useful ability.  Phone photos can also be uploaded. Please delete all of your 
     Assistants BEFORE deleting your account (to prevent a database error).
     """)
@@ -770,7 +3145,11 @@ def login_sidebar():
     username = st.sidebar.text_input("Username")
     password = st.sidebar.text_input("Password", type="password")
     if st.sidebar.button("Login"):
-        user_id, thread_id, assistant_id = verify_user(username, password)
+        try:
+            user_id, thread_id, assistant_id = verify_user(username, password)
+        except PasswordHashBusy:
+            st.sidebar.error("The server is busy with other logins. Please try again in a moment.")
+            return
         if user_id:
             st.session_state.user_id = user_id
             st.session_state.thread_id = thread_id
@@ -778,15 +3157,17 @@ def login_sidebar():
             logging.info(f"User {username} logged in. Thread ID: {thread_id}")
             st.sidebar.success(f"Logged in as {username}")
 
-            st.session_state.assistants = load_user_assistants(user_id)
+            st.session_state.file_info = get_assistant_files()
+            st.session_state.deleted_file_ids = load_queued_file_deletions(user_id)
+            st.session_state.assistants = load_user_assistants(user_id, st.session_state.file_info)
+            load_session_state(user_id)
             if st.session_state.assistants:
                 st.sidebar.info(f"Loaded {len(st.session_state.assistants)} assistants for user {username}")
             else:
                 st.sidebar.warning("No existing assistants found. Please create a new assistant.")
 
-            st.session_state.file_info = get_assistant_files()
-
             if thread_id:
+                open_transcript(thread_id)
                 st.sidebar.info(f"Loaded existing thread: {thread_id}")
             else:
                 st.sidebar.warning("No existing thread found. Please create a new thread to start a conversation.")
@@ -803,6 +3184,8 @@ def login_sidebar():
                 st.session_state.assistants = {}
                 st.sidebar.success(f"Account created for {username}")
                 st.rerun()
+            except PasswordHashBusy:
+                st.sidebar.error("The server is busy with other logins. Please try again in a moment.")
             except Exception as e:
                 st.sidebar.error("Username already exists or error occurred")
                 logging.error(f"Error creating user: {str(e)}")
@@ -815,69 +3198,120 @@ def login_sidebar():
             if st.session_state.thread_id:
                 update_user_thread_id(st.session_state.user_id, st.session_state.thread_id)
 
-            for key in ['user_id', 'thread_id', 'username', 'assistants', 'selected_assistant']:
-                if key in st.session_state:
-                    del st.session_state[key]
+            clear_user_session()
             st.rerun()
 
-def load_user_assistants(user_id):
-    conn = get_db_connection()
-    with conn.cursor() as c:
-        c.execute("SELECT assistant_id, name, description, instructions, file_ids FROM user_assistants WHERE user_id = %s",
-                  (user_id,))
-        rows = c.fetchall()
-    conn.close()
+def load_user_assistants(user_id, available_files=None):
+    # available_files is a file catalog fetched just now (login). Refreshes pass none and only reload rows:
+    # an older catalog would misread files attached since by another session as stale.
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("""
+                SELECT ua.assistant_id, ua.name, ua.description, ua.instructions, ua.tools, ua.tool_resources,
+                       ua.truncation_last_messages, ua.max_prompt_tokens, ua.max_completion_tokens,
+                       ua.state_version, af.file_id
+                FROM user_assistants ua
+                LEFT JOIN assistant_files af ON af.assistant_id = ua.assistant_id
+                WHERE ua.user_id = %s
+                ORDER BY ua.id, af.created_at
+            """, (user_id,))
+            rows = c.fetchall()
     assistants = {}
     for row in rows:
-        assistant_id = row['assistant_id']
         name = row['name']
-        description = row['description']
-        instructions = row['instructions']
-        file_ids = json.loads(row['file_ids'])
-
-        # Sync with available files
-        available_files = get_assistant_files()
-        synced_file_ids = [fid for fid in file_ids if
-                           fid in available_files['assistants'] or fid in available_files['vision']]
-
-        assistants[name] = {
-            'id': assistant_id,
-            'description': description,
-            'instructions': instructions,
-            'file_ids': synced_file_ids
-        }
-
-        # Update the database if file_ids changed
-        if synced_file_ids != file_ids:
-            conn = get_db_connection()
+        if name not in assistants:
+            if row['tools'] is not None and row['tool_resources'] is not None:
+                tool_state_cache[row['assistant_id']] = {'tools': json.loads(row['tools']),
+                                                         'tool_resources': json.loads(row['tool_resources']),
+                                                         'version': row['state_version']}
+            assistants[name] = {
+                'id': row['assistant_id'],
+                'description': row['description'],
+                'instructions': row['instructions'],
+                'file_ids': [],
+                'run_settings': {setting: row[setting] for setting in RUN_SETTINGS},
+                'version': row['state_version']
+            }
+        if row['file_id']:
+            assistants[name]['file_ids'].append(row['file_id'])
+
+    if available_files is None:
+        return assistants
+
+    # Reconcile every assistant against the one file catalog fetched at login
+    stale_rows = []
+    for assistant in assistants.values():
+        stale_file_ids = [fid for fid in assistant['file_ids'] if
+                          fid not in available_files['assistants'] and fid not in available_files['vision']]
+        if stale_file_ids:
+            assistant['file_ids'] = [fid for fid in assistant['file_ids'] if fid not in stale_file_ids]
+            assistant['version'] += 1
+            if assistant['id'] in tool_state_cache:
+                tool_state_cache[assistant['id']]['version'] += 1
+            stale_rows.extend((assistant['id'], fid) for fid in stale_file_ids)
+
+    # Drop rows for files that no longer exist on OpenAI in one transaction
+    if stale_rows:
+        with get_db_connection() as conn:
             with conn.cursor() as c:
-                c.execute("UPDATE user_assistants SET file_ids = %s WHERE assistant_id = %s",
-                          (json.dumps(synced_file_ids), assistant_id))
+                c.executemany("DELETE FROM assistant_files WHERE assistant_id = %s AND file_id = %s", stale_rows)
+                bump_assistant_versions(c, sorted({assistant_id for assistant_id, _ in stale_rows}))
             conn.commit()
-            conn.close()
+        logging.info(f"Removed {len(stale_rows)} stale file references for user {user_id}")
     return assistants
 
+def refresh_user_assistants():
+    # Once per full run: reload the session's assistants if another instance or browser session has changed,
+    # added or removed any of them, so file lists pushed to OpenAI start from the current attachments
+    user_id = st.session_state.user_id
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute("SELECT assistant_id, state_version FROM user_assistants WHERE user_id = %s", (user_id,))
+                versions = {row['assistant_id']: row['state_version'] for row in c.fetchall()}
+        session_versions = {assistant['id']: assistant.get('version')
+                            for assistant in st.session_state.assistants.values()}
+        if versions == session_versions:
+            return
+        logging.info(f"Assistants for user {user_id} changed elsewhere, reloading")
+        st.session_state.assistants = load_user_assistants(user_id)
+    except Exception as e:
+        logging.error(f"Error refreshing assistants for user {user_id}: {str(e)}")
+
 def update_user_thread_id(user_id, thread_id):
-    conn = get_db_connection()
-    with conn.cursor() as c:
-        c.execute("UPDATE users SET thread_id = %s WHERE id = %s", (thread_id, user_id))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("UPDATE users SET thread_id = %s WHERE id = %s", (thread_id, user_id))
+        conn.commit()
     logging.info(f"Updated thread_id for user {user_id}: {thread_id}")
 
 def create_thread():
     try:
-        response = client.beta.threads.create()
+        response = run_openai(aclient.beta.threads.create)
         logging.debug(f"Thread created with ID: {response.id}")
 
-        for file_id in st.session_state.deleted_file_ids:
-            delete_file_from_openai(file_id)
+        # Removed files are no longer referenced by the old thread; the background worker deletes them
+        release_file_deletions(st.session_state.user_id)
+        st.session_state.broadcast_threads = {}
 
         return response
     except Exception as e:
         logging.error(f"Error creating thread (did you forget to remove files from assistants?): {str(e)}")
         return None
 
+def run_cli(args):
+    commands = {'migrate': migrate_db, 'reset-db': reset_db}
+    if len(args) != 1 or args[0] not in commands:
+        print(f"Usage: python app.py [{'|'.join(commands)}]")
+        return 2
+    commands[args[0]]()
+    return 0
+
 if __name__ == '__main__':
-    init_db()
-    run_streamlit()
+    # "streamlit run app.py" serves the UI; "python app.py <command>" runs admin commands
+    if runtime.exists():
+        ensure_schema()
+        get_file_gc_worker()
+        run_streamlit()
+    else:
+        sys.exit(run_cli(sys.argv[1:]))
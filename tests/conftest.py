@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# app.py builds its OpenAI clients at import time
+os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def test_db(monkeypatch):
+    # Points app.py at a disposable MySQL database: TEST_DB_NAME, plus optional TEST_DB_HOST, TEST_DB_USER and
+    # TEST_DB_PASS. Processes spawned by the test inherit the environment.
+    if not os.environ.get('TEST_DB_NAME'):
+        pytest.skip("TEST_DB_NAME not set")
+    monkeypatch.setenv('DB_NAME', os.environ['TEST_DB_NAME'])
+    for name in ['DB_HOST', 'DB_USER', 'DB_PASS']:
+        if f'TEST_{name}' in os.environ:
+            monkeypatch.setenv(name, os.environ[f'TEST_{name}'])
+    monkeypatch.delenv('INSTANCE_CONNECTION_NAME', raising=False)
@@ -0,0 +1,50 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app
+
+# Pooled vs unpooled checkouts against the test_db MySQL server; run with RUN_BENCHMARKS=1 pytest -s
+CHECKOUTS = int(os.environ.get('BENCHMARK_DB_CHECKOUTS', '400'))
+THREADS = [1, 8]
+
+pytestmark = pytest.mark.skipif(not os.environ.get('RUN_BENCHMARKS'), reason="RUN_BENCHMARKS not set")
+
+def query(conn):
+    with conn.cursor() as c:
+        c.execute("SELECT 1 AS one")
+        assert c.fetchone()['one'] == 1
+
+def unpooled_checkout(_):
+    # What get_db_connection did before the pool: a new connection per call
+    conn = app.create_db_connection()
+    try:
+        query(conn)
+    finally:
+        conn.close()
+
+def timed(checkout, threads):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(checkout, range(CHECKOUTS)))
+    return time.perf_counter() - started
+
+def test_pooled_vs_unpooled_checkouts(test_db):
+    for threads in THREADS:
+        pool = app.ConnectionPool(app.create_db_connection, app.DB_POOL_SIZE, app.DB_POOL_TIMEOUT,
+                                  app.DB_POOL_IDLE_SECONDS, app.DB_POOL_PING_SECONDS)
+
+        def pooled_checkout(_):
+            with pool.acquire() as conn:
+                query(conn)
+
+        unpooled = timed(unpooled_checkout, threads)
+        pooled = timed(pooled_checkout, threads)
+        print(f"\n{threads} thread(s), {CHECKOUTS} checkouts: unpooled {unpooled / CHECKOUTS * 1000:.2f}ms, "
+              f"pooled {pooled / CHECKOUTS * 1000:.2f}ms per checkout ({unpooled / pooled:.1f}x), "
+              f"pool stats {pool.stats()}")
+        # Connections are reused rather than opened per checkout
+        assert pool.stats()['created'] <= min(threads, app.DB_POOL_SIZE)
+        assert pooled < unpooled
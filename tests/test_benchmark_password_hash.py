@@ -0,0 +1,35 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import argon2
+import pytest
+
+import app
+
+# Logins per second per core through PasswordHashPool at several Argon2 cost settings; run with
+# RUN_BENCHMARKS=1 pytest -s. Settings are time_cost:memory_cost_kib:parallelism.
+COSTS = [tuple(int(value) for value in setting.split(':'))
+         for setting in os.environ.get('BENCHMARK_PASSWORD_COSTS', '1:19456:1,2:19456:1,3:65536:4').split(',')]
+LOGINS = int(os.environ.get('BENCHMARK_PASSWORD_LOGINS', '40'))
+PASSWORD = 'correct horse battery staple'
+
+pytestmark = pytest.mark.skipif(not os.environ.get('RUN_BENCHMARKS'), reason="RUN_BENCHMARKS not set")
+
+def test_logins_per_second_per_core():
+    pool = app.PasswordHashPool()
+    cores = min(app.PASSWORD_HASH_WORKERS, os.cpu_count() or 1)
+    # verify reads the cost parameters from each hash, so one pool serves every setting
+    hashes = [argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost,
+                                    parallelism=parallelism).hash(PASSWORD)
+              for time_cost, memory_cost, parallelism in COSTS]
+    with ThreadPoolExecutor(max_workers=app.PASSWORD_HASH_WORKERS) as logins:
+        # Start the worker processes before timing
+        assert all(logins.map(lambda _: pool.verify(PASSWORD, hashes[0]), range(app.PASSWORD_HASH_WORKERS)))
+        for (time_cost, memory_cost, parallelism), hashed in zip(COSTS, hashes):
+            started = time.perf_counter()
+            assert all(logins.map(lambda _: pool.verify(PASSWORD, hashed), range(LOGINS)))
+            rate = LOGINS / (time.perf_counter() - started)
+            print(f"\ntime_cost={time_cost} memory_cost={memory_cost}KiB parallelism={parallelism}: "
+                  f"{rate:.1f} logins/s on {cores} worker core(s), {rate / cores:.1f} per core")
+    assert pool.stats()['rejected'] == 0
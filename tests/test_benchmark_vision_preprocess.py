@@ -0,0 +1,43 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+import app
+
+# Timing and bytes saved by preprocess_vision_image over a directory of sample images (the README screenshots
+# by default); run with RUN_BENCHMARKS=1 pytest -s, and BENCHMARK_IMAGE_DIR for your own corpus
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE_DIR = os.environ.get('BENCHMARK_IMAGE_DIR', os.path.join(REPO_DIR, 'img'))
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+pytestmark = pytest.mark.skipif(not os.environ.get('RUN_BENCHMARKS'), reason="RUN_BENCHMARKS not set")
+
+def test_preprocess_corpus():
+    names = sorted(name for name in os.listdir(IMAGE_DIR) if name.lower().endswith(IMAGE_EXTENSIONS))
+    assert names, f"No images in {IMAGE_DIR}"
+    total_before = total_after = total_seconds = 0
+    for name in names:
+        with open(os.path.join(IMAGE_DIR, name), 'rb') as f:
+            original = f.read()
+        started = time.perf_counter()
+        result = app.preprocess_vision_image(original, name)
+        seconds = time.perf_counter() - started
+        if result is None:
+            after, upload_name = len(original), name
+        else:
+            data, upload_name = result
+            # What gets uploaded must still be a readable image within the size limit
+            with Image.open(io.BytesIO(data)) as image:
+                assert max(image.size) <= app.VISION_MAX_EDGE
+            after = len(data)
+        total_before += len(original)
+        total_after += after
+        total_seconds += seconds
+        print(f"\n{name}: {len(original)} -> {after} bytes as {upload_name} in {seconds * 1000:.1f}ms")
+    saved = total_before - total_after
+    print(f"\n{len(names)} images: {total_before} -> {total_after} bytes "
+          f"({saved / total_before:.1%} saved) in {total_seconds * 1000:.1f}ms, "
+          f"{total_seconds / len(names) * 1000:.1f}ms per image")
@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import app
+
+REMOTE_FILES = {
+    'assistants': [('file-doc', 'notes.pdf'), ('file-csv', 'data.csv')],
+    'vision': [('file-img', 'photo.png')],
+}
+
+ASSISTANT_ROWS = [
+    {'assistant_id': 'asst_1', 'name': 'First', 'file_id': 'file-doc'},
+    {'assistant_id': 'asst_1', 'name': 'First', 'file_id': 'file-gone'},
+    {'assistant_id': 'asst_2', 'name': 'Second', 'file_id': 'file-img'},
+    {'assistant_id': 'asst_2', 'name': 'Second', 'file_id': 'file-csv'},
+    {'assistant_id': 'asst_3', 'name': 'Third', 'file_id': None},
+]
+
+class FakeCursor:
+    def __init__(self, db):
+        self._db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self._db.statements.append((sql, params))
+
+    def executemany(self, sql, rows):
+        self._db.statements.append((sql, list(rows)))
+
+    def fetchall(self):
+        return [dict(row, description='', instructions='', tools=None, tool_resources=None,
+                     truncation_last_messages=None, max_prompt_tokens=None, max_completion_tokens=None,
+                     state_version=0)
+                for row in ASSISTANT_ROWS]
+
+class FakeDb:
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+def test_login_lists_files_once_per_purpose(monkeypatch):
+    list_calls = []
+
+    def fake_list(purpose):
+        list_calls.append(purpose)
+
+        async def pages():
+            for file_id, filename in REMOTE_FILES[purpose]:
+                yield SimpleNamespace(id=file_id, filename=filename)
+        return pages()
+
+    def no_per_file_lookup(*args, **kwargs):
+        raise AssertionError("login must not look up files one at a time")
+
+    db = FakeDb()
+    monkeypatch.setattr(app.aclient.files, 'list', fake_list)
+    monkeypatch.setattr(app.aclient.files, 'retrieve', no_per_file_lookup)
+    monkeypatch.setattr(app, 'fetch_file_metadata', no_per_file_lookup)
+    monkeypatch.setattr(app, 'get_db_connection', lambda: db)
+
+    # The same two steps login_sidebar runs after a successful password check
+    file_info = app.get_assistant_files()
+    assistants = app.load_user_assistants(1, file_info)
+
+    assert sorted(list_calls) == ['assistants', 'vision']
+    assert assistants['First']['file_ids'] == ['file-doc']
+    assert assistants['Second']['file_ids'] == ['file-img', 'file-csv']
+    assert assistants['Third']['file_ids'] == []
+
+    # One query for the assistants, one batched delete for the stale reference and its version bump
+    deletes = [params for sql, params in db.statements if 'DELETE FROM assistant_files' in sql]
+    assert deletes == [[('asst_1', 'file-gone')]]
+    bumps = [params for sql, params in db.statements if 'state_version = state_version + 1' in sql]
+    assert bumps == [[('asst_1',)]]
+    assert assistants['First']['version'] == 1
+    assert len(db.statements) == 3
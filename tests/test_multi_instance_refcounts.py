@@ -0,0 +1,70 @@
+import multiprocessing
+
+import app
+
+# The test drops and recreates every table in the test_db database
+ROUNDS = 20
+TOOLS = [{'type': 'code_interpreter'}]
+
+def instance(index, barrier, results):
+    # One app instance: its own process, connection pool and tool_state_cache
+
+    app.get_assistant_tool_state('asst_a')
+    barrier.wait()
+    for i in range(ROUNDS):
+        file_id = f'file-{index}-{i}'
+        app.attach_file_to_assistant('asst_a', file_id, 'assistants', shared=True)
+        app.attach_file_to_assistant('asst_b', file_id, 'assistants', shared=True)
+        if i % 2:
+            app.detach_file_from_assistant('asst_a', file_id)
+        # Both instances attach and detach the same file on the same assistants
+        app.attach_file_to_assistant('asst_b', 'file-shared', 'assistants', shared=True)
+        app.detach_file_from_assistant('asst_b', 'file-shared')
+    if index == 1:
+        app.save_assistant_tool_state('asst_a', TOOLS, {'code_interpreter': {'file_ids': ['file-from-1']}})
+    barrier.wait()
+    results.put((index, app.get_assistant_tool_state('asst_a')['tool_resources']))
+
+def test_two_instances_keep_refcounts_consistent(test_db):
+    app.reset_db()
+    with app.get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("INSERT INTO users (username, password) VALUES ('refcounts', '')")
+            user_id = c.lastrowid
+            c.executemany("""
+                INSERT INTO user_assistants (user_id, assistant_id, name, tools, tool_resources)
+                VALUES (%s, %s, %s, %s, %s)
+            """, [(user_id, assistant_id, name, '[{"type": "code_interpreter"}]',
+                   '{"code_interpreter": {"file_ids": []}}') for assistant_id, name in [('asst_a', 'A'),
+                                                                                          ('asst_b', 'B')]])
+        conn.commit()
+
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(2)
+    results = context.Queue()
+    processes = [context.Process(target=instance, args=(index, barrier, results)) for index in range(2)]
+    for process in processes:
+        process.start()
+    seen = dict(results.get(timeout=60) for _ in processes)
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    # Instance 0 had cached asst_a before instance 1 changed it
+    assert seen[0] == seen[1] == {'code_interpreter': {'file_ids': ['file-from-1']}}
+
+    with app.get_db_connection() as conn:
+        with conn.cursor() as c:
+            c.execute("SELECT file_id, COUNT(*) AS refs FROM assistant_files GROUP BY file_id")
+            refcounts = {row['file_id']: row['refs'] for row in c.fetchall()}
+            c.execute("SELECT assistant_id, state_version FROM user_assistants")
+            versions = {row['assistant_id']: row['state_version'] for row in c.fetchall()}
+    assert refcounts == {f'file-{index}-{i}': 1 if i % 2 else 2 for index in range(2) for i in range(ROUNDS)}
+    # Every attach and every detach that removed a row bumped its assistant's version exactly once; how many
+    # file-shared detaches found a row depends on how the instances interleaved
+    assert versions['asst_a'] == 2 * (ROUNDS + ROUNDS // 2) + 1
+    assert 4 * ROUNDS < versions['asst_b'] <= 6 * ROUNDS
+
+    assistants = app.load_user_assistants(user_id, {'assistants': dict.fromkeys(refcounts, ''), 'vision': {}})
+    assert assistants['A']['version'] == versions['asst_a']
+    assert sorted(assistants['B']['file_ids']) == sorted(refcounts)
@@ -0,0 +1,33 @@
+from concurrent.futures.process import BrokenProcessPool
+
+import argon2
+import pytest
+
+import app
+
+class DeadExecutor:
+    # Stands in for a ProcessPoolExecutor whose worker was killed
+    def __init__(self):
+        self.shut_down = False
+
+    def submit(self, fn, *args):
+        raise BrokenProcessPool("A child process terminated abruptly")
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+def test_broken_pool_is_replaced():
+    pool = app.PasswordHashPool()
+    dead = DeadExecutor()
+    pool._executor = dead
+
+    with pytest.raises(app.PasswordHashBusy):
+        pool.hash('correct horse')
+    assert dead.shut_down
+    assert pool.stats()['restarts'] == 1
+
+    # The next login goes to the new workers
+    hashed = pool.hash('correct horse')
+    assert pool.verify('correct horse', hashed)
+    with pytest.raises(argon2.exceptions.VerifyMismatchError):
+        pool.verify('wrong', hashed)
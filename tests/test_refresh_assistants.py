@@ -0,0 +1,63 @@
+import streamlit as st
+
+import app
+
+ASSISTANT_ROW = dict(assistant_id='asst_1', name='First', description='', instructions='', tools=None,
+                     tool_resources=None, truncation_last_messages=None, max_prompt_tokens=None,
+                     max_completion_tokens=None, state_version=1)
+
+class FakeCursor:
+    # What instance B left behind: file-new attached to asst_1, bumping it to version 1
+    def __init__(self, db):
+        self._db = db
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self._db.statements.append((sql, params))
+        if 'SELECT assistant_id, state_version' in sql:
+            self._rows = [{'assistant_id': 'asst_1', 'state_version': 1}]
+        else:
+            self._rows = [dict(ASSISTANT_ROW, file_id=file_id) for file_id in ['file-doc', 'file-new']]
+
+    def executemany(self, sql, rows):
+        self._db.statements.append((sql, list(rows)))
+
+    def fetchall(self):
+        return self._rows
+
+class FakeDb:
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+def test_refresh_keeps_files_attached_by_another_instance(monkeypatch):
+    db = FakeDb()
+    monkeypatch.setattr(app, 'get_db_connection', lambda: db)
+    # Instance A logged in before file-new existed, so its catalog doesn't know it
+    st.session_state.user_id = 1
+    st.session_state.file_info = {'assistants': {'file-doc': 'notes.pdf'}, 'vision': {}}
+    st.session_state.assistants = {'First': {'id': 'asst_1', 'description': '', 'instructions': '',
+                                             'file_ids': ['file-doc'], 'run_settings': {}, 'version': 0}}
+
+    app.refresh_user_assistants()
+
+    assert st.session_state.assistants['First']['file_ids'] == ['file-doc', 'file-new']
+    assert st.session_state.assistants['First']['version'] == 1
+    assert not [sql for sql, _ in db.statements if 'DELETE' in sql or 'state_version + 1' in sql]